@@ -29,12 +29,18 @@ class AdvertisementPacket (api.Packet):
   packet has a destination address.
   The latter is the destination for which this is a route advertisement.
   """
+  __slots__ = ('latency', 'destination')
+
   def __init__ (self, destination, latency):
     super(AdvertisementPacket, self).__init__()
     self.latency = latency
     self.destination = destination
-    self.outer_color = [1, 0, 1, 1]
-    self.inner_color = [1, 0, 1, 1]
+
+  def _new_outer_color (self):
+    return [1, 0, 1, 1]
+
+  def _new_inner_color (self):
+    return [1, 0, 1, 1]
 
   def __repr__ (self):
     n = getattr(self.destination, "name", str(self.destination))
@@ -142,6 +148,9 @@ class DVRouterBase (api.Entity):
   # Whether to randomize router timers
   __RANDOMIZE_TIMERS = False
 
+  _in_batch = False # In handle_rx_batch()?
+  _batch_triggered = False # Was a triggered update put off during it?
+
   @property
   def INFINITY (self):
     return DVRouterBase.__INFINITY
@@ -273,6 +282,58 @@ class DVRouterBase (api.Entity):
     else:
       self.on_data_packet(packet, in_port)
 
+  def handle_rx_batch (self, packets):
+    """
+    Called by the framework with packets which arrived at the same time.
+
+    Route advertisements in the batch are handled after expiring routes
+    just once.  Triggered updates which send_routes() defers (see
+    _defer_send_routes()) are rolled up into a single send_routes() call
+    at the end of the batch.
+
+    !!! DO NOT OVERRIDE THIS METHOD !!!
+    """
+    if len(packets) == 1:
+      self.handle_rx(*packets[0])
+      return
+
+    self._in_batch = True
+    try:
+      expired = False
+      for packet, in_port in packets:
+        if isinstance(packet, AdvertisementPacket):
+          if not expired:
+            self.expire_routes()
+            expired = True
+          self.on_route_advertisement(packet.destination,
+                                      packet.latency,
+                                      in_port)
+        else:
+          self.handle_rx(packet, in_port)
+    finally:
+      self._in_batch = False
+      triggered = self._batch_triggered
+      self._batch_triggered = False
+
+    if triggered:
+      self.send_routes(force=False)
+
+  def _defer_send_routes (self, force=False, single_port=None):
+    """
+    Says whether send_routes() should put off this call
+
+    While handling a batch of packets, triggered updates (force=False to
+    all ports) are put off until the end of the batch so that there's
+    just one of them.  send_routes() can call this first thing and return
+    if it returns True.  If it doesn't, triggered updates just go out
+    right away.
+
+    !!! DO NOT OVERRIDE THIS METHOD !!!
+    """
+    if not self._in_batch or force or single_port is not None: return False
+    self._batch_triggered = True
+    return True
+
   def handle_timer (self):
     """
     Called periodically when the router should send tables to neighbors
@@ -519,8 +580,8 @@ class TableEntry (namedtuple("TableEntry",
 # they're how we know when to call add_static_route().  Thus, we make
 # them invisible in the simulator.
 from sim.basics import HostDiscoveryPacket
-HostDiscoveryPacket.outer_color = [0, 0, 0, 0]
-HostDiscoveryPacket.inner_color = [0, 0, 0, 0]
+HostDiscoveryPacket._outer_color = [0, 0, 0, 0]
+HostDiscoveryPacket._inner_color = [0, 0, 0, 0]
 
 
 
@@ -109,6 +109,9 @@ class DVRouter (DVRouterBase):
     :single_port: if not None, sends updates only to that port; to
                   be used in conjunction with on_link_up().
     """
+    # a triggered update in the middle of a batch goes out at its end
+    if self._defer_send_routes(force, single_port): return
+
     # before sending, check if there's any expired routes..
     self.expire_routes()
     
@@ -0,0 +1,60 @@
+"""
+Times how long it takes a switch to flood a packet
+
+This is for working on the simulator itself.  It makes a hub with some hosts
+attached and times how long the hub takes to handle a Ping it received: read
+its src and dst (as a switch would) and flood it out of the other ports.  The
+cables are plain Cables, which don't do anything with what they're given, so
+only the switch's side is timed.  Run it with something like:
+  python simulator.py --no-interactive examples.packet_bench --ports=4
+
+Options:
+  --ports=N   Ports to flood to (default 4)
+  --count=N   Packets to flood (default 100000)
+"""
+
+import sys
+import time
+
+import sim.basics as basics
+from sim.cable import Cable
+from examples.hub import Hub
+
+
+class CaptureCable (Cable):
+  """
+  Keeps what it's given instead of delivering it
+  """
+  def __init__ (self):
+    self.packets = []
+
+  def transfer (self, packet):
+    self.packets.append(packet)
+
+
+def launch (ports = 4, count = 100000):
+  ports = int(ports)
+  count = int(count)
+
+  hub = Hub.create("bench_hub")
+  hosts = [basics.BasicHost.create("bench_h%s" % (i,)) for i in range(ports+1)]
+  capture = CaptureCable()
+  hub.linkTo(hosts[0], (Cable, capture))
+  for h in hosts[1:]:
+    hub.linkTo(h, Cable)
+
+  # Get a copy of a Ping as it would arrive at the hub (on port 0)
+  hosts[0].send(basics.Ping(hosts[1], data="bench"), 0)
+  p = capture.packets.pop()
+
+  send = hub.send
+  start = time.time()
+  for _ in range(count):
+    p.ttl = 20
+    p.src, p.dst
+    send(p, 0, flood=True)
+  elapsed = time.time() - start
+
+  print("%.2f microseconds per packet flooded to %s ports"
+        % (elapsed / count * 1e6, ports))
+  sys.exit(0)
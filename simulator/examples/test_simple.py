@@ -56,7 +56,8 @@ def launch ():
 
     h3.ping(h1)
 
-    yield 5 # Wait five seconds for pings to be delivered
+    # Wait for the pings to be delivered (or at most five seconds)
+    yield api.wait_until(max_time=5)
 
     good = True
     if h1.pings != 2:
@@ -91,6 +91,4 @@ class LearningSwitch (LearningSwitchBase):
     if packet.dst.name in self.routing_table:
       self.send(packet, self.routing_table[packet.dst.name][0])
     else:
-      for port,latency in self.ports.up:
-        if port != in_port:
-          self.send(packet, port)
+      self.send(packet, in_port, flood=True)
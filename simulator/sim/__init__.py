@@ -26,10 +26,31 @@ class SimConfiguration (object):
 
   debug_startup = False
 
+  virtual_time = False # Run as fast as possible instead of in real time
+  tick = None # Seconds per tick for an integer clock (None for float seconds)
+
+  _packet_trace = "full"
+
   remote_interface = "tcp" # Probably "tcp", "udp", or None
   remote_interface_address = "127.0.0.1"
   remote_interface_port = 65432
 
+  @property
+  def packet_trace (self):
+    """
+    What packets keep in their .trace
+
+    "full" is every entity they go through, "ring" is just the last few,
+    "hops" is just how many (see Packet.hops), and "off" is nothing.
+    """
+    return self._packet_trace
+
+  @packet_trace.setter
+  def packet_trace (self, mode):
+    from sim.api import _set_trace_mode
+    _set_trace_mode(mode)
+    self._packet_trace = mode
+
   @property
   def default_switch_type (self):
     if self._default_switch_type: return self._default_switch_type
@@ -0,0 +1,149 @@
+"""
+A World which runs on an asyncio event loop
+
+Use --asyncio on the commandline to get this instead of the normal World.
+It requires Python 3.
+
+The normal World runs in its own thread and waits on a threading.Event
+between events.  This one keeps the same heap and timer wheel, but instead
+of waiting itself, it keeps a single loop.call_at() armed for the earliest
+event.  When that goes off, it runs everything that's due (for a limited
+slice of time, so that other things on the loop get a turn) and then arms
+it again for whatever is next.  The remote interfaces (see comm_aio) are
+served by the same loop, so there aren't any threads per connection.
+
+Coroutines running on the loop can wait for simulated time to pass with:
+  await core.world.sleep(seconds)
+To run a coroutine on the World's loop from another thread (e.g., the
+console), use asyncio.run_coroutine_threadsafe(coro, core.world.loop).
+"""
+
+import asyncio
+import time
+
+import sim
+import sim.core as core
+from sim.core import simlog, _get_ident
+
+
+def _wake (future):
+  if not future.done(): future.set_result(None)
+
+
+class World (core.World):
+  SLICE = 0.05 # Most seconds to spend running events before yielding
+
+  def __init__ (self, loop = None):
+    self.loop = loop or asyncio.new_event_loop()
+    self._handle = None # TimerHandle for the next _step()
+    self._handle_at = None # Loop time _handle is for
+    self._stepping = False # In _step() right now?
+    self._kicked = False # Asked the loop to call _arm()?
+    super(World, self).__init__()
+
+  def _create_interface (self):
+    if sim.config.remote_interface in ("tcp", "web"):
+      import sim.comm_aio as interface
+      return interface.interface()
+    return super(World, self)._create_interface()
+
+  def _schedule (self, t, ev, key = None):
+    core.World._schedule(self, t, ev, key)
+    if self._stepping:
+      pass # _step() will take care of it
+    elif _get_ident() == self._thread_ident:
+      self._arm()
+    elif not self._kicked:
+      self._kicked = True
+      self.loop.call_soon_threadsafe(self._arm)
+    return ev
+
+  def _arm (self):
+    """
+    Makes sure _step() gets called when the next event is due
+    """
+    self._kicked = False
+    t = self._next_time()
+    if t is None: return
+    if self.virtual_time:
+      at = self.loop.time()
+    else:
+      at = self.loop.time() + self._seconds(t - self._now()) / self.speed
+    if self._handle is not None:
+      if self._handle_at <= at: return
+      self._handle.cancel()
+    self._handle_at = at
+    self._handle = self.loop.call_at(at, self._step)
+
+  def _step (self):
+    """
+    Runs events which are due
+    """
+    self._handle = None
+    self._stepping = True
+    try:
+      if self.virtual_time:
+        until = float("inf")
+      else:
+        until = self._now()
+        t = self._next_time()
+        if t is not None: self._note_lag(self._seconds(until - t))
+      end = time.time() + self.SLICE
+      self._loop_virtual(until=until, stop=lambda: time.time() > end)
+    except Exception:
+      simlog.exception("Simulation ended due to exception")
+      self.loop.stop()
+      return
+    finally:
+      self._stepping = False
+    if self._running:
+      self._arm()
+    else:
+      self.loop.stop()
+
+  def _run_loop (self):
+    asyncio.set_event_loop(self.loop)
+    self._thread_ident = _get_ident()
+    self._arm()
+    try:
+      self.loop.run_forever()
+    except KeyboardInterrupt:
+      pass
+    except SystemExit:
+      simlog.debug("Simulation stopped")
+      raise
+    finally:
+      simlog.debug("Simulation ended")
+      self.ended = True
+
+  _run_real = _run_loop
+  _run_virtual = _run_loop
+
+  def stop (self):
+    super(World, self).stop()
+    self.loop.call_soon_threadsafe(self.loop.stop)
+
+  def run_until (self, *args, **kw):
+    if self._stepping:
+      # The loop would just spin without the asyncio loop getting a turn
+      raise RuntimeError("run_until() can't be used from within the "
+                         "simulation; yield api.wait_until() from a "
+                         "tasklet instead")
+    return super(World, self).run_until(*args, **kw)
+
+  def sleep (self, seconds):
+    """
+    Sleeps for the given amount of time
+
+    From a coroutine on the World's loop, use "await world.sleep(seconds)".
+    From other threads, this just blocks (as it does in the normal World).
+    """
+    return self.sleepUntil(seconds + self.time)
+
+  def sleepUntil (self, time):
+    """ Like sleep() except waits for an absolute time instead of relative. """
+    if _get_ident() != self._thread_ident:
+      return super(World, self).sleepUntil(time)
+    f = self.loop.create_future()
+    self.doAt(time, _wake, f)
+    return f
@@ -3,6 +3,7 @@ The main APIs for the simulator
 """
 
 from __future__ import print_function
+import copy
 import sim.core as core
 from random import random as rand
 
@@ -152,9 +153,10 @@ def run_tasklet (_generator, *_args, **_kw):
   Python generator, which basically looks like a function, except it has
   'yield' statements in it.  The tasklet runs until it reaches such a yield.
   If you yield None, the tasklet ends.  If you yield a number, the tasklet
-  will sleep for that number of seconds before being scheduled again.  This is
-  nothing you couldn't do with timers, but sometimes it's easier to write them
-  in this style.
+  will sleep for that number of seconds before being scheduled again.  If
+  you yield wait_until(...), it waits until that's done, and the yield
+  gives why (see wait_until()).  This is nothing you couldn't do with
+  timers, but sometimes it's easier to write them in this style.
 
   Example:
   def annoying (n):
@@ -166,17 +168,69 @@ def run_tasklet (_generator, *_args, **_kw):
   """
   gen = _generator(*_args, **_kw)
 
-  def iterate ():
-    try:
-      sleepytime = next(gen)
+  def iterate (why = None):
+    while True:
+      try:
+        sleepytime = gen.send(why)
+      except StopIteration:
+        return
       if sleepytime is None: return
-      create_timer(sleepytime, iterate, False)
-    except StopIteration:
-      return
+      if not isinstance(sleepytime, core.Wait):
+        create_timer(sleepytime, iterate, False)
+        return
+      why = sleepytime.start(iterate)
+      if why is None: return # It'll call iterate() when it's done
 
   iterate()
 
 
+def wait_until (predicate = None, max_time = None, idle_for = None):
+  """
+  Makes a tasklet wait for things to settle down
+
+  Yield what this returns from a tasklet, e.g.:
+    why = yield api.wait_until(max_time=5)
+  The tasklet continues once there are no packets (or other non-timer
+  events) in flight (or once there have been none for idle_for seconds),
+  once predicate() returns True (it's checked after each event), or once
+  max_time seconds have passed, whichever is first.  why is "idle",
+  "predicate", or "time", respectively.
+  """
+  return core.Wait(predicate, max_time, idle_for)
+
+
+def run_until (predicate = None, max_time = None, idle_for = None):
+  """
+  Runs the simulation until it's done, and says why it stopped
+
+  This is for scripts, which can call it instead of starting the
+  simulation and guessing how long to wait.  It stops for the same things
+  as wait_until() (or returns "stopped" if the simulation was stopped).
+  From within the simulation (e.g., in a tasklet), use wait_until().
+  """
+  return core.world.run_until(predicate, max_time, idle_for)
+
+
+def bulk ():
+  """
+  Builds a big topology more quickly
+
+  Use it in a with statement:
+    with api.bulk() as b:
+      hosts = b.create(basics.BasicHost, ["h%s" % i for i in range(1000)])
+      switches = b.create(MySwitch, ["s%s" % i for i in range(100)])
+      b.link(zip(hosts, switches * 10))
+      switches[0].linkTo(switches[1])
+  Inside it, you create and link Entities as usual (b.create() and b.link()
+  just do a bunch at once).  But rather than telling the visualizer and the
+  Entities about each one as it happens, it waits until the end.  Then the
+  visualizer gets the whole topology at once, and all the handle_link_up()
+  calls are done in a single event (in the same order as they would have
+  been).
+  """
+  return core.bulk()
+
+
 def hsv_to_rgb (h, s, v, a = 1):
   """
   Convert hue, saturation, value (0..1) to RGBA.
@@ -199,8 +253,56 @@ def hsv_to_rgb (h, s, v, a = 1):
   return [r,g,b,a]
 
 
+# How packets keep track of where they've been (see sim.config.packet_trace).
+# Each of these takes a packet's _trace and the Entity it just got to, and
+# returns the new _trace.  It's a tuple of EntityIDs except in "hops" mode,
+# where it's just a count.
+def _trace_off (trace, entity):
+  return trace
+
+def _trace_hops (trace, entity):
+  if type(trace) is not int: trace = len(trace)
+  return trace + 1
+
+def _trace_ring (trace, entity):
+  if type(trace) is int: trace = ()
+  trace += (core.entity_ref(entity),)
+  if len(trace) > Packet.TRACE_LENGTH: trace = trace[-Packet.TRACE_LENGTH:]
+  return trace
+
+def _trace_full (trace, entity):
+  if type(trace) is int: trace = ()
+  return trace + (core.entity_ref(entity),)
+
+_trace_modes = dict(off=_trace_off, hops=_trace_hops, ring=_trace_ring,
+                    full=_trace_full)
+_add_hop = _trace_full
+
+def _set_trace_mode (mode):
+  global _add_hop
+  if mode not in _trace_modes:
+    raise RuntimeError("Packet trace mode must be one of: "
+                       + ", ".join(sorted(_trace_modes)))
+  _add_hop = _trace_modes[mode]
+
+
 class Packet (object):
   DEFAULT_TTL = 20
+  TRACE_LENGTH = 8 # Entities kept in the trace in "ring" mode
+
+  # Packets only get a dict if they're given a color or a subclass adds
+  # fields without listing them in its own __slots__ (which is fine, but
+  # takes more memory).  The src, dst, and trace are kept as EntityIDs (see
+  # core.entity_ref()).
+  __slots__ = ('_src', '_dst', 'ttl', '_trace', '_payload', '__dict__')
+
+  # When using NetVis, packets are visible, and you can set the color (see
+  # outer_color and inner_color).  Until something does, it's None here, and
+  # they're made up when first used.  A subclass can set these to give all
+  # its packets the same colors, and can also set them before calling
+  # Packet.__init__().
+  _outer_color = None
+  _inner_color = None
 
   def __init__ (self, dst=NullAddress, src=NullAddress):
     """
@@ -214,19 +316,133 @@ class Packet (object):
     be either simple primitive types, or plain ol' containers (lists,
     tuples, dicts) containing primitive types or more plain ol' containers
     (containing primitive types or more plain 'ol containers containing...).
+    If you have lots of packets, list the fields in __slots__ like
+    basics.Ping does so that they take less memory.
+
+    When a packet is sent, each port gets its own copy, so whoever receives
+    it can change it without affecting anyone else, and changing the packet
+    after sending it doesn't change the copies.  Containers are only copied
+    one level deep, though, so don't change containers inside of them.
     """
+    self._payload = None
     self.src = src
     self.dst = dst
     self.ttl = self.DEFAULT_TTL # Decremented for each entity we go through.
-    self.trace = [] # List of entities we've been sent through.  For debugging.
+    self._trace = ()
+
+  @property
+  def src (self):
+    return core.entity_deref(self._src)
+
+  @src.setter
+  def src (self, value):
+    self._src = core.entity_ref(value)
+
+  @property
+  def dst (self):
+    return core.entity_deref(self._dst)
+
+  @dst.setter
+  def dst (self, value):
+    self._dst = core.entity_ref(value)
+
+  @property
+  def trace (self):
+    """
+    List of entities we've been sent through.  For debugging.
+
+    What's kept depends on sim.config.packet_trace.  In "full" mode, it's
+    all of them; in "ring" mode, it's the last TRACE_LENGTH; and in "off"
+    and "hops" modes, it's empty.
+    """
+    t = self._trace
+    if type(t) is int: return []
+    return [core.entity_deref(e) for e in t]
+
+  @trace.setter
+  def trace (self, value):
+    self._trace = tuple(core.entity_ref(e) for e in value)
+
+  @property
+  def hops (self):
+    """
+    The number of entities we've been sent through
+
+    Only counts in "hops" and "full" modes (see trace).
+    """
+    t = self._trace
+    return t if type(t) is int else len(t)
+
+  @property
+  def outer_color (self):
+    """
+    The packet's color in NetVis
+
+    This is a list of red, green, blue, and (optionally) alpha values.
+    Each value is between 0 and 1.  alpha of 0 is transparent.  1 is opaque.
+    If you don't set it, it's made up by _new_outer_color() the first time
+    it's used (which is only when there's a visualizer to show it).
+    """
+    c = self._outer_color
+    if c is None:
+      if self._payload is None:
+        c = self._new_outer_color()
+      else:
+        c = copy.copy(self._payload.outer_color)
+      self._outer_color = c
+    return c
+
+  @outer_color.setter
+  def outer_color (self, value):
+    self._outer_color = value
+
+  @property
+  def inner_color (self):
+    """
+    The color of the middle of the packet in NetVis (see outer_color)
+    """
+    c = self._inner_color
+    if c is None:
+      if self._payload is None:
+        c = self._new_inner_color()
+      else:
+        c = copy.copy(self._payload.inner_color)
+      self._inner_color = c
+    return c
+
+  @inner_color.setter
+  def inner_color (self, value):
+    self._inner_color = value
 
-    # When using NetVis, packets are visible, and you can set the color.
-    # color is a list of red, green, blue, and (optionally) alpha values.
-    # Each value is between 0 and 1.  alpha of 0 is transparent.  1 is opaque.
-    if not hasattr(self, 'outer_color'):
-      self.outer_color = hsv_to_rgb(rand(), rand()*.8+.2, rand()*.5+.5,.75)
-    if not hasattr(self, 'inner_color'):
-      self.inner_color = [0,0,0,0] # transparent
+  def _new_outer_color (self):
+    """
+    Returns the outer_color for a packet which doesn't have one yet
+    """
+    return hsv_to_rgb(rand(), rand()*.8+.2, rand()*.5+.5,.75)
+
+  def _new_inner_color (self):
+    """
+    Returns the inner_color for a packet which doesn't have one yet
+    """
+    return [0,0,0,0] # transparent
+
+  def __getattr__ (self, name):
+    # Only called for attributes which aren't found normally.  Copies made
+    # by sending (see core._duplicate_packet()) don't hold fields which are
+    # only in the original's dict; they come from the original packet.
+    # Containers get copied the first time they're used so that changing
+    # them doesn't change the other copies.
+    if name in Packet.__slots__ or name.startswith('__'):
+      raise AttributeError(name)
+    payload = self._payload
+    if payload is None:
+      raise AttributeError("%r object has no attribute %r"
+                           % (type(self).__name__, name))
+    v = getattr(payload, name)
+    if isinstance(v, (dict, list, set)):
+      v = copy.copy(v)
+      setattr(self, name, v)
+    return v
 
   def _notify_rx (self, srcEnt, srcPort, dstEnt, dstPort, drop):
     """
@@ -234,7 +450,7 @@ class Packet (object):
 
     Meant for internal use.
     """
-    if not drop: self.trace.append(dstEnt)
+    if not drop: self._trace = _add_hop(self._trace, dstEnt)
 
   def _notify_tx (self, srcEnt, srcPort, dstEnt, dstPort, drop):
     """
@@ -255,6 +471,8 @@ class Entity (object):
   Base class for all entities (switches, hosts, etc.).
   """
   name = "Unnamed" # Gets set later
+  _entity_id = None # Gets set later (see core.entity_ref())
+  _topo = None # TopoNode; gets set later
   NO_LOG = False # Can be used to force off the log for this entity
   LOG_LEVEL = "debug" # Default level for .log()
 
@@ -270,14 +488,16 @@ class Entity (object):
     """
     return core.CreateEntity(name, cls, *args, **kw)
 
+  # The methods which do things to the Entity in the simulation (like
+  # send() and linkTo()) pass them on to its TopoNode.  They don't do
+  # anything for Entities which weren't made with create().
+
   def get_port_count (self):
     """
     Returns the number of ports this entity has.
-
-    This function may appear to be unimplemented, but it does
-    in fact work.
     """
-    pass
+    if self._topo is None: return None
+    return len(self._topo.ports)
 
   def handle_rx (self, packet, port):
     """
@@ -289,6 +509,21 @@ class Entity (object):
     """
     pass
 
+  def handle_rx_batch (self, packets):
+    """
+    Called by the framework with packets which arrived at the same time.
+
+    packets is a list of (packet, port) pairs.
+    You don't need to override this; by default, the framework just calls
+    handle_rx() for each packet.  But if your Entity can do some work once
+    per batch instead of once per packet, you can override it.
+    Note that overriding it changes the order things happen in: packets
+    for this Entity are then handled after the other events scheduled for
+    the same time rather than as they arrive.
+    """
+    for packet, port in packets:
+      self.handle_rx(packet, port)
+
   def handle_link_up (self, port, latency):
     """
     Called by the framework when a link attached to this Entity goes up.
@@ -312,11 +547,10 @@ class Entity (object):
 
     The message should, for example, show up in the GUI.
     This is probably defunct now.
-
-    This function may appear to be unimplemented, but it does
-    in fact work (maybe).
     """
-    pass
+    if self._topo is None: return
+    core.world.do(core.events.set_debug, self.name,
+                  ' '.join((str(s) for s in args)))
 
   def log (self, msg, *args, **kwargs):
     """
@@ -333,11 +567,16 @@ class Entity (object):
     If you're lucky, there's some more information somewhere about configuring
     the logs.
     Note that you can also use api.userlog.debug(...) and friends directly.
-
-    This function may appear to be unimplemented, but it does
-    in fact work.
     """
-    pass
+    if self._topo is None or self.NO_LOG: return
+    level = self.LOG_LEVEL
+    if "level" in kwargs:
+      level = kwargs.pop("level").lower()
+    if level not in ['debug', 'info', 'warning', 'error', 'critical', 'exception']:
+      level = "debug"
+    func = getattr(userlog, level)
+    msg = "%s:" + str(msg) # Black magic
+    func(msg, self.name, *args, **kwargs)
 
   def send (self, packet, port=None, flood=False):
     """
@@ -348,20 +587,41 @@ class Entity (object):
     port can be a numeric port number, or a list of port numbers.
     If flood is True, the meaning of port is reversed -- packets will
     be sent from all ports EXCEPT those listed.
+    """
+    if self._topo is None: return
+    self._topo.send(packet, port, flood)
 
-    This function may appear to be unimplemented, but it does
-    in fact work.
+  def linkTo (self, other, cable = None, fillEmpty = True, latency = None):
     """
-    pass
+    Connects this entity to another one (see core.TopoNode.linkTo())
+
+    Returns the port numbers used at each end.
+    """
+    if self._topo is None: return None
+    return self._topo.linkTo(other, cable, fillEmpty, latency)
+
+  def unlinkTo (self, other, right_now = False):
+    """
+    Takes down all the links between this entity and another one
+    """
+    if self._topo is None: return
+    self._topo.unlinkTo(other, right_now)
+
+  def disconnect (self):
+    """
+    Takes down all of this entity's links
+    """
+    if self._topo is None: return
+    self._topo.disconnect()
 
   def remove (self):
     """
     Removes this entity from existence.
-
-    This function may appear to be unimplemented, but it does
-    in fact work.
     """
-    pass
+    if self._topo is None: return
+    self._topo.disconnect()
+    core.world.do(core.events.send_entity_down, self.name)
+    core.registry.remove(self._entity_id)
 
   def __repr__ (self):
     return "<%s %s>" % (type(self).__name__, get_name(self))
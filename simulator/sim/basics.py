@@ -42,12 +42,12 @@ class BasicHost (api.HostEntity):
       # Silently drop messages not to anyone in particular
       return
 
-    trace = ','.join((s.name for s in packet.trace))
+    trace = _TraceNames(packet)
 
     if packet.dst is not self:
-      self.log("NOT FOR ME: %s %s" % (packet, trace), level="WARNING")
+      self.log("NOT FOR ME: %s %s", packet, trace, level="WARNING")
     else:
-      self.log("rx: %s %s" % (packet, trace))
+      self.log("rx: %s %s", packet, trace)
       if type(packet) is Ping and self.ENABLE_PONG:
         # Trace this path
         import sim.core as core
@@ -56,18 +56,40 @@ class BasicHost (api.HostEntity):
         self.send(Pong(packet), port)
 
 
+class _TraceNames (object):
+  """
+  A packet's trace as a string (only worked out if it actually gets logged)
+  """
+  __slots__ = ('packet',)
+
+  def __init__ (self, packet):
+    self.packet = packet
+
+  def __str__ (self):
+    return ','.join((s.name for s in self.packet.trace))
+
+
 class Ping (api.Packet):
   """
   A Ping packet
   """
+  __slots__ = ('data', '_color')
+
   def __init__ (self, dst, data=None, color=None):
     super(Ping,self).__init__(dst=dst)
     self.data = data
-    self.outer_color[3] = 0.8 # Mostly opaque
-    self.inner_color = [1,1,1,.8] # white
-    if color:
-      for i,c in enumerate(color):
-        self.outer_color[i] = c
+    self._color = color
+
+  def _new_outer_color (self):
+    c = super(Ping,self)._new_outer_color()
+    c[3] = 0.8 # Mostly opaque
+    if self._color:
+      for i,v in enumerate(self._color):
+        c[i] = v
+    return c
+
+  def _new_inner_color (self):
+    return [1,1,1,.8] # white
 
   def __repr__ (self):
     d = self.data
@@ -87,13 +109,18 @@ class Pong (api.Packet):
 
   It's a returned Ping.  The original Ping is in the .original property.
   """
+  __slots__ = ('original',)
+
   def __init__ (self, original):
     super(Pong,self).__init__(dst=original.src)
     self.original = original
 
-    # Flip colors from original
-    self.outer_color = original.inner_color
-    self.inner_color = original.outer_color
+  # Flip colors from original
+  def _new_outer_color (self):
+    return self.original.inner_color
+
+  def _new_inner_color (self):
+    return self.original.outer_color
 
   def __repr__ (self):
     return "<Pong " + str(self.original) + ">"
@@ -103,8 +130,9 @@ class HostDiscoveryPacket (api.Packet):
   """
   Just a way that hosts say hello
   """
-  outer_color = [1,1,0,1]
-  inner_color = [1,1,0.5,0.5]
+  __slots__ = ()
+  _outer_color = [1,1,0,1]
+  _inner_color = [1,1,0.5,0.5]
   def __init__ (self, *args, **kw):
     # Call original constructor
     super(HostDiscoveryPacket, self).__init__(*args, **kw)
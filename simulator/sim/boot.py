@@ -137,12 +137,47 @@ def pre_options (default_host_type = None, default_switch_type = None,
                  gui_log = False, console_log = True, debug_startup = True,
                  remote_interface = "web", remote_interface_port = 65432,
                  remote_interface_address = "0.0.0.0", interactive = True,
-                 very_quiet = False, readline = True,
-                 **kw):
+                 very_quiet = False, readline = True, virtual_time = False,
+                 asyncio = False, profile = False, record = None,
+                 replay = None, replay_stop = None, speed = 1,
+                 catch_up = "burst", tick = None, packet_trace = None,
+                 console_names = None, **kw):
   """
   Set up initial options and create world
 
   Should return unused options (which will be passed to post_options)
+
+  If virtual_time is set, the simulator doesn't follow the wall clock;
+  instead, it jumps straight to the time of the next event and runs as
+  fast as it can.  This is great for running tests which would otherwise
+  spend most of their time waiting around.
+
+  In real time, speed makes the clock run faster (e.g., 10) or slower
+  (e.g., 0.1) than the wall clock.  If events run late, catch_up says what
+  to do about it: "burst" runs them as fast as possible to catch up, "warn"
+  does the same but logs a warning, and "skip" lets the simulation fall
+  behind instead (see World._note_lag()).
+
+  If tick is set, the simulator keeps time as a whole number of ticks of
+  that many seconds instead of as floating point seconds (with just --tick,
+  it uses nanoseconds).  This keeps event times exact.
+
+  packet_trace says what packets keep track of as they go: "full" (the
+  default when interactive), "ring" (the default otherwise), "hops", or
+  "off".  See sim.config.packet_trace.
+
+  If console_names is set, each Entity can be used from the console by its
+  name (e.g., h1.ping(h2)).  This is the default when interactive.
+
+  If asyncio is set, the simulation runs on an asyncio event loop (see
+  sim.aio).  This needs Python 3.
+
+  If profile is set, the simulator keeps track of where it spends its time
+  and prints a report at exit (see sim.profiler).
+
+  If record is set, the run is recorded to that file.  If replay is set,
+  the recording in that file is replayed (in virtual time), stopping after
+  replay_stop events if that's set.  See sim.replay.
   """
 
   if very_quiet:
@@ -159,6 +194,11 @@ def pre_options (default_host_type = None, default_switch_type = None,
   sim.config.debug_startup = debug_startup
   sim.config.interactive = interactive
   sim.config.readline = readline
+  sim.config.virtual_time = virtual_time or bool(replay)
+  if tick is True: tick = 1e-9
+  sim.config.tick = float(tick) if tick else None
+  if packet_trace is None: packet_trace = "full" if interactive else "ring"
+  sim.config.packet_trace = packet_trace
 
   sim.config.default_host_type = default_host_type
   sim.config.default_switch_type = default_switch_type
@@ -171,7 +211,29 @@ def pre_options (default_host_type = None, default_switch_type = None,
 
   import sim.core as core
   global w
-  w = core.World()
+  if asyncio:
+    import sim.aio as aio
+    w = aio.World()
+  else:
+    w = core.World()
+  if catch_up not in ("burst", "skip", "warn"):
+    raise RuntimeError("catch-up must be burst, skip, or warn")
+  w.speed = float(speed)
+  w.catch_up = catch_up
+  if profile:
+    w.profile()
+    import atexit
+    atexit.register(w.profile_report)
+  if record:
+    from sim.replay import Recorder
+    Recorder(w, record)
+  if replay:
+    from sim.replay import Replayer
+    Replayer(w, replay,
+             None if replay_stop is None else int(replay_stop))
+  if console_names is None: console_names = interactive
+  if console_names:
+    core.registry.names = variables
   global simlog
   simlog = core.simlog
 
@@ -3,6 +3,8 @@ Cables are how Entities are connected
 """
 
 import random
+from collections import deque
+from heapq import heappush, heappop
 import sim.core as core
 
 class Cable (object):
@@ -53,16 +55,16 @@ class DumbCable (Cable):
       self.latency = latency
 
   def transfer (self, packet):
-    def rx ():
-      packet._notify_rx(self.srcEnt, self.srcPort, self.dstEnt, self.dstPort, False)
-
-      self.dstEnt.handle_rx(packet, self.dstPort)
-
-    core.world.doLater(self.latency, rx)
+    core.world.doLater(self.latency, self._rx, packet)
 
     core.events.packet(self.srcEnt.name, self.dstEnt.name, packet, self.latency)
     packet._notify_tx(self.srcEnt, self.srcPort, self.dstEnt, self.dstPort, False)
 
+  def _rx (self, packet):
+    packet._notify_rx(self.srcEnt, self.srcPort, self.dstEnt, self.dstPort, False)
+
+    core.world.deliver(self.dstEnt, packet, self.dstPort)
+
 
 class BasicCable (DumbCable):
   """
@@ -71,14 +73,37 @@ class BasicCable (DumbCable):
   Models transmission delay as well as latency and properly drops packets
   which were on the wire when a link goes down (which is pretty important
   for sensible link down behavior).
+
+  The packets on the wire are in .queue as (time, key, packet) tuples,
+  where the time is when the packet comes out, in the World's internal
+  units (see World._units()).  (It used to be (time, packet), with the
+  time in seconds, so subclasses which look at the queue may need
+  updating.)  If a packet would make the queue longer than queue_size,
+  drop() gets called with it at the end of the queue to get rid of one
+  entry.  The default is to drop the new one (tail drop).  If the queue
+  is a heap (see REORDER), everything before the new packet is in heap
+  order, and a drop() which gets rid of something else has to leave the
+  whole queue a heap (e.g., with heapq.heapify()).
   """
   DEFAULT_QUEUE_SIZE = None # Unlimited
   DEFAULT_TX_TIME = 0.1 # Transmission delay
 
+  # Packets on a cable normally come out in the order they went in, so the
+  # queue is a deque of (time, key, packet), where the key is the one the
+  # World would give an event scheduled when the packet was sent (see
+  # World._key()).  Subclasses which can reorder packets (e.g., by giving
+  # them different latencies) should set this, which makes the queue a heap
+  # instead.  A cable switches to the heap by itself if it ever sees a
+  # packet due before the last one (e.g., when its latency gets lowered
+  # while packets are on the wire).
+  REORDER = False
+
   def __init__ (self, *args, **kw):
     self.size = kw.pop("queue_size", self.DEFAULT_QUEUE_SIZE)
-    self.queue = [] # time, packet
-    self.next_delivery = None
+    self._new_queue()
+    self.next_delivery = None # When _wakeup will call deliver() (or None)
+    self._wakeup = None # The one deliver() Event (reused each time)
+    self._wakeup_key = None # And its key
 
     super(BasicCable, self).__init__(*args, **kw)
 
@@ -86,22 +111,43 @@ class BasicCable (DumbCable):
 
     self._tx_stop = None # Time at which current transfer ends (or None)
 
+  def _new_queue (self):
+    self._reorder = self.REORDER
+    self.queue = [] if self._reorder else deque()
+
+  def _to_heap (self):
+    """ Switches the queue to a heap """
+    self._reorder = True
+    self.queue = list(self.queue) # Already in order, so already a heap
+
   def drop (self):
     del self.queue[-1] # Tail drop
 
   def sched (self):
+    """
+    Makes sure deliver() gets called when the packet at the head is due
+
+    There's only ever one deliver() pending.  It only gets moved if the
+    head is now due sooner than it (which, since the queue is normally
+    FIFO, is only when the queue was empty).  It has the key of the packet
+    at the head, so it goes in the same order relative to other events at
+    the same time no matter when it was (re)scheduled.
+    """
     if not self.queue: return
-    assert [x[0] for x in self.queue] == [x[0] for x in sorted(self.queue, key=self._queue_key)]
-    #self.queue.sort() # We could do better than this! (And have, apparently)
-    t = self.queue[0][0]
-    self.next_delivery = None
-    if self.next_delivery is None or t < self.next_delivery:
-      self.next_delivery = t
-      core.world.doAt(t, self.deliver)
+    t,key,_ = self.queue[0]
+    if self.next_delivery is not None:
+      if (self.next_delivery, self._wakeup_key) <= (t, key): return
+      self._wakeup.cancel()
+    ev = self._wakeup
+    if ev is None or ev.queued: ev = core.Event(None)
+    self._wakeup = core.world._redo_keyed(ev, t, key, self.deliver)
+    self.next_delivery = t
+    self._wakeup_key = key
 
   def deliver (self):
     if self.src: self.old_src = self.src
     if self.dst: self.old_dst = self.dst
+    if self._wakeup is not None: self._wakeup.cancel() # If called directly
     self.next_delivery = None
     drop = False
     if not self.src or self.src.ports[self.srcPort] is not self:
@@ -110,20 +156,25 @@ class BasicCable (DumbCable):
         drop = True
         return
 
-    while self.queue:
-      if self.queue[0][0] > core.world.time: break
-      p = self.queue.pop(0)[1]
+    now = core.world._now()
+    while self.queue and self.queue[0][0] <= now:
+      if self._reorder:
+        p = heappop(self.queue)[2]
+      else:
+        p = self.queue.popleft()[2]
       self._do_deliver(p, drop)
     self.sched()
 
   def _do_deliver (self, p, drop):
     p._notify_rx(self.srcEnt, self.srcPort, self.dstEnt, self.dstPort, drop)
     if not drop:
-      self.dstEnt.handle_rx(p, self.dstPort)
+      core.world.deliver(self.dstEnt, p, self.dstPort)
 
   def transfer (self, packet):
-    now = core.world.time
-    tx_time = self.tx_time
+    # Times here are in the World's internal units (see World._units())
+    world = core.world
+    now = world._now()
+    tx_time = world._units(self.tx_time)
     if self._tx_stop is None or now >= self._tx_stop:
       # Not transferring
       tx_at = now
@@ -133,15 +184,24 @@ class BasicCable (DumbCable):
       tx_at = self._tx_stop
       self._tx_stop += tx_time
 
-    self.queue.append((tx_at + tx_time + self.latency,packet))
-    if self.size is not None and len(self.queue) > self.size:
-      self.drop()
-
-    if len(self.queue) >= 2:
-      if self.queue[-1][0] < self.queue[-2][0]:
-        # Deliver last before second-to-last?
-        # Simple answer: just sort
-        self.queue.sort(key=self._queue_key)
+    t = tx_at + tx_time + world._units(self.latency)
+    key = world._key()
+    q = self.queue
+    if not self._reorder and q and t < q[-1][0]:
+      # Would come out before the last one, so it needs a heap after all
+      self._to_heap()
+      q = self.queue
+    if self._reorder:
+      # Append it (so that drop() gets it) and then put it in its place
+      q.append((t, key, packet))
+      if self.size is not None and len(q) > self.size:
+        self.drop()
+      else:
+        heappush(q, q.pop())
+    else:
+      q.append((t, key, packet))
+      if self.size is not None and len(q) > self.size:
+        self.drop()
 
     self.sched()
 
@@ -150,11 +210,10 @@ class BasicCable (DumbCable):
     packet._notify_tx(self.srcEnt, self.srcPort, self.dstEnt, self.dstPort, False)
 
   def _handle_disconnect (self):
-    del self.queue[:]
-
-  @staticmethod
-  def _queue_key (queue_item):
-    return queue_item[0]
+    self._new_queue()
+    # Don't leave a delivery for a dead link hanging around in the queue
+    if self._wakeup is not None: self._wakeup.cancel()
+    self.next_delivery = None
 
 
 class UnreliableCable (BasicCable):
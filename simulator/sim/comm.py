@@ -3,6 +3,37 @@ This simulator can call methods in this class to inform external
 programs that various events have occurred.
 """
 
+def topology_message ():
+  """
+  Returns an "initialize" message with all the entities and links
+  """
+  import sim.core as core
+  import sim.api as api
+
+  def make (a,A, b,B):
+    a = a.entity.name
+    b = b.entity.name
+    if a <= b:
+      return (a,A,b,B)
+    return (b,B,a,A)
+
+  nodes = core.registry.all_nodes()
+  links = set()
+  for te in nodes:
+    for n,p in enumerate(te.ports):
+      if p is None: continue
+      links.add(make(te, n, p.dst, p.dstPort))
+  links = [list(e) for e in links]
+
+  return {
+    'type':'initialize',
+    'entities':dict([(n.entity.name,
+                 'circle' if isinstance(n.entity, api.HostEntity) else 'square')
+                for n in nodes]),
+    'links':links,
+  }
+
+
 class NullInterface (object):
   """ Interface that does nothing / base class """
   def send_console(self, text):
@@ -23,6 +54,10 @@ class NullInterface (object):
   def send_link_up (self, srcid, sport, dstid, dport):
     pass
 
+  def send_snapshot (self):
+    """ Sends the whole topology (see topology_message()) """
+    pass
+
   def send_info (self, msg):
     pass
 
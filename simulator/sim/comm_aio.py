@@ -0,0 +1,220 @@
+"""
+asyncio versions of the remote interfaces
+
+When running with --asyncio (see sim.aio), these get used instead of
+comm_tcp and comm_web.  Rather than a thread (or two) per connection, all
+connections are served by the World's event loop.  They speak exactly the
+same protocols as the originals.
+
+Requires Python 3.
+"""
+
+import asyncio
+import errno
+import mimetypes
+import os
+import struct
+import base64
+import hashlib
+
+import sim
+import sim.core as core
+from sim.core import _get_ident
+import sim.comm_tcp as comm_tcp
+from sim.comm_web import WebHandler, log
+
+
+MAX_BUFFERED = 4 * 1024 * 1024 # Drop viewers which fall further behind
+
+
+def _write (writer, data):
+  """
+  Writes to a connection from any thread
+  """
+  if writer.transport.get_write_buffer_size() > MAX_BUFFERED:
+    raise RuntimeError("Remote end isn't keeping up")
+  if _get_ident() == core.world._thread_ident:
+    writer.write(data)
+  else:
+    core.world.loop.call_soon_threadsafe(writer.write, data)
+
+
+class StreamingConnection (comm_tcp.StreamingConnection):
+  def __init__ (self, parent, reader, writer):
+    self.parent = parent
+    self.reader = reader
+    self.writer = writer
+
+  async def serve (self):
+    self._send_initialize()
+    self.parent.connections.append(self)
+    try:
+      while True:
+        l = await self.reader.readline()
+        if not l: break
+        self._process_incoming(l)
+    except Exception:
+      pass
+    self.parent._disconnect(self)
+
+  def send_raw (self, msg):
+    _write(self.writer, msg.encode())
+
+  def _close (self):
+    self.writer.close()
+
+
+class WebConnection (WebHandler):
+  """
+  A WebHandler which runs on the World's loop
+
+  This only serves plain files and the websocket, which is all NetVis needs.
+  """
+  def __init__ (self, parent, reader, writer):
+    self.server = parent
+    self.reader = reader
+    self.writer = writer
+
+  async def serve (self):
+    try:
+      while True:
+        line = await self.reader.readline()
+        parts = line.decode("latin-1").split()
+        if len(parts) < 2: break
+        headers = {}
+        while True:
+          h = await self.reader.readline()
+          if not h.strip(): break
+          k,_,v = h.decode("latin-1").partition(":")
+          headers[k.strip().lower()] = v.strip()
+
+        if headers.get("upgrade", "").lower() == "websocket":
+          await self._serve_websocket(headers)
+          break
+        self._serve_file(parts[0], parts[1])
+        if headers.get("connection", "").lower() == "close": break
+    except (asyncio.IncompleteReadError, ConnectionError):
+      pass
+    except Exception:
+      log.exception("Error serving web connection")
+    if self._websocket_open:
+      log.debug("Done reading websocket")
+    self.server._disconnect(self)
+    self.writer.close()
+
+  def _serve_file (self, method, path):
+    filename = self.translate_path(path)
+    if os.path.isdir(filename):
+      filename = os.path.join(filename, "index.html")
+    try:
+      with open(filename, "rb") as f:
+        body = f.read()
+      status = "200 OK"
+      ctype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    except (IOError, OSError):
+      body = b"File not found"
+      status = "404 Not Found"
+      ctype = "text/plain"
+    hdr = ("HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %s\r\n\r\n"
+           % (status, ctype, len(body)))
+    if method == "HEAD": body = b""
+    self.writer.write(hdr.encode("latin-1") + body)
+    self.log_message('"%s %s" %s', method, path, status.split()[0])
+
+  async def _serve_websocket (self, headers):
+    log.debug("Upgrading to websocket")
+    k = headers.get("sec-websocket-key", "")
+    k += "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+    k = base64.b64encode(hashlib.sha1(k.encode("UTF-8")).digest())
+    self.writer.write(b"HTTP/1.1 101 Switching Protocols\r\n"
+                      b"Upgrade: websocket\r\nConnection: Upgrade\r\n"
+                      b"Sec-WebSocket-Accept: " + k + b"\r\n\r\n")
+
+    self._websocket_open = True
+    self.server.connections.append(self)
+    self._send_initialize()
+
+    read = self.reader.readexactly
+    data = b''
+    old_op = None
+    while self._websocket_open:
+      flags_op,len1 = struct.unpack("!BB", await read(2))
+      op = flags_op & 0x0f
+      fin = flags_op & 0x80
+      if (len1 & 0x80) == 0: raise RuntimeError("No mask set")
+      length = len1 & 0x7f
+      if length == 0x7e:
+        length = struct.unpack("!H", await read(2))[0]
+      elif length == 0x7f:
+        length = struct.unpack("!Q", await read(8))[0]
+      mask = await read(4)
+      d = await read(length)
+      d = bytes(c ^ mask[i % 4] for i,c in enumerate(d))
+
+      if not fin:
+        if op == self.WS_CONTINUE:
+          if old_op is None: raise RuntimeError("Continuing unknown opcode")
+        else:
+          if old_op is not None: raise RuntimeError("Discarded partial message")
+          old_op = op
+        data += d
+        continue
+
+      if op == self.WS_CONTINUE:
+        if old_op is None: raise RuntimeError("Can't continue unknown frame")
+        op = old_op
+      d = data + d
+      old_op = None
+      data = b''
+      if op == self.WS_TEXT: d = d.decode('utf8')
+
+      if op in (self.WS_TEXT, self.WS_BINARY):
+        self._ws_message(op, d)
+      elif op == self.WS_PING:
+        self._send_real(self._frame(self.WS_PONG, d))
+      elif op == self.WS_CLOSE:
+        self._websocket_open = False
+
+  def _send_real (self, msg):
+    _write(self.writer, msg)
+
+  def _close (self):
+    self._websocket_open = False
+
+
+class StreamingInterface (comm_tcp.StreamingInterface):
+  CONNECTION_CLASS = StreamingConnection
+
+  def __init__ (self):
+    self.connections = []
+    self.server = None
+    address = sim.config.remote_interface_address
+    port = sim.config.remote_interface_port
+    try:
+      self.server = core.world.loop.run_until_complete(
+          asyncio.start_server(self._accept, address, port))
+    except OSError as e:
+      if e.errno != errno.EADDRINUSE: raise
+      core.simlog.error("Couldn't listen for remote interfaces because port "
+                        "%s is already in use.", port)
+      return
+    self._started(port)
+
+  def _started (self, port):
+    core.simlog.debug("Listening for remote interfaces on port %s", port)
+
+  async def _accept (self, reader, writer):
+    await self.CONNECTION_CLASS(self, reader, writer).serve()
+
+
+class WebInterface (StreamingInterface):
+  CONNECTION_CLASS = WebConnection
+
+  def _started (self, port):
+    log.info("Webserver running at http://%s:%s", "127.0.0.1", port)
+
+
+def interface ():
+  if sim.config.remote_interface == "web":
+    return WebInterface()
+  return StreamingInterface()
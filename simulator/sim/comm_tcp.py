@@ -25,31 +25,7 @@ class StreamingConnection (comm.NullInterface):
 
   def _send_initialize (self):
     parent = self.parent
-
-    def make (a,A, b,B):
-      a = a.entity.name
-      b = b.entity.name
-      if a <= b:
-        return (a,A,b,B)
-      return (b,B,a,A)
-
-    links = set()
-    for te in core.topo.values():
-      for n,p in enumerate(te.ports):
-        if p is None: continue
-        links.add(make(te, n, p.dst, p.dstPort))
-    links = [list(e) for e in links]
-
-    import sim.api
-    msg = {
-      'type':'initialize',
-      'entities':dict([(n.entity.name,
-                   'circle' if isinstance(n.entity, sim.api.HostEntity) else 'square')
-                  for n in core.topo.values()]),
-      #      'entities': {},
-      'links':links,
-    }
-    parent.send(msg, connections=self)
+    parent.send(comm.topology_message(), connections=self)
     if core.world.info:
       msg = {
         'type':'info', 'text':core.world.info
@@ -245,12 +221,16 @@ class StreamingInterface (object):
       'node2_port':dport,
       })
 
+  def send_snapshot (self):
+    self.send(comm.topology_message())
+
   def packet (self, n1, n2, packet, duration, drop=False):
+    if not self.connections: return # Don't bother making up colors
     m = {
       "type":"packet",
       "node1":n1,
       "node2":n2,
-      "duration":duration * 1000,
+      "duration":duration * 1000 / core.world.speed,
       "stroke":packet.outer_color,
       "fill":packet.inner_color,
       "drop":drop,
@@ -12,11 +12,17 @@ import sim
 import copy
 import threading
 try:
-  import queue as Queue
+  from threading import get_ident as _get_ident
 except ImportError:
-  import Queue
+  from thread import get_ident as _get_ident
 import time
-import weakref
+_monotonic = getattr(time, "monotonic", time.time) # Python 2 doesn't have it
+import itertools
+from collections import deque
+from heapq import heappush, heappop, heapify
+from bisect import bisect_left
+from contextlib import contextmanager
+from sim.timerwheel import TimerWheel
 
 import logging
 import traceback
@@ -100,21 +106,98 @@ def _catch (_f, *_args, **_kw):
     simlog.exception("Exception while executing %s(%s)" % (_f, args))
 
 
+def _dispatch (o, m, ev):
+  """
+  Runs the method for a queue entry
+
+  The loops do this themselves; this is for hooks (see World._hook).
+  """
+  if ev.kw is not None:
+    m(*(ev.args or ()), **ev.kw)
+  elif ev.args is not None:
+    m(*ev.args)
+  else:
+    m()
+
+
+def _source_of (m, args):
+  """
+  Returns the ID of the Entity an event is for (or -1 if it's not for one)
+
+  This is the "source" part of the keys of events it schedules (see
+  World._key()).  Events for an Entity are its own methods, those of the
+  Cables delivering to it, and its Timers.
+  """
+  obj = getattr(m, '__self__', None)
+  if obj is None:
+    if m is _catch and args: return _source_of(args[0], args[1:])
+    return -1
+  if isinstance(obj, Timer): return _source_of(obj.func, obj.args)
+  i = getattr(obj, '_entity_id', None)
+  if i is None:
+    i = getattr(getattr(obj, 'dstEnt', None), '_entity_id', None) # Cables
+  return -1 if i is None else i
+
+
+class Event (object):
+  """
+  A scheduled event
+
+  World.doLater() and friends return one of these.  Calling .cancel() on
+  it keeps it from ever happening.  Cancelled events aren't pulled out of
+  the queue right away; they're just marked dead (which also lets go of
+  the function and arguments), and the World skips them.
+  """
+  __slots__ = ('method', 'args', 'kw', 'timer', 'queued', 'born')
+
+  def __init__ (self, method, args=None, kw=None, timer=False):
+    self.method = method # Set to None once it has run or been cancelled
+    self.args = args or None # None if there are no (keyword) arguments,
+    self.kw = kw or None     # so that the World can take a fast path
+    self.timer = timer # Is this in the timer wheel instead of the heap?
+    self.queued = False # Is this in the heap/wheel/inbox right now?
+    # .born (when it was scheduled) is only set while profiling
+
+  @property
+  def pending (self):
+    """ True if the event has neither happened nor been cancelled """
+    return self.method is not None
+
+  def cancel (self):
+    if self.method is None: return
+    self.method = None
+    self.args = self.kw = None
+    if self.queued and not self.timer:
+      world._dead += 1
+      if _get_ident() == world._thread_ident: world._maybe_compact()
+
+  def __lt__ (self, other):
+    # Entries in the heap only get this far if their keys are the same,
+    # which only happens when an Event is rescheduled with the key of a
+    # cancelled one (see World._redo_keyed()).  Either order is fine.
+    return False
+
+  def __repr__ (self):
+    if self.method is None: return "<Event (dead)>"
+    return "<Event %s>" % (self.method,)
+
+
 class Timer (object):
   """ It's a timer.
   You should just create this with api.create_timer()."""
   def __init__ (self, seconds, target=None, args=(), kw={}, passSelf=False):
     self.seconds = seconds
-    world.doLater(seconds, self.timeout)
     self.func = target
     self.stopped = False
     self.args = list(args)
     self.kw = dict(kw)
     if passSelf:
       self.args = [self] + self.args
+    self._event = world.doTimerLater(seconds, self.timeout)
 
   def cancel (self):
     self.stopped = True
+    self._event.cancel()
 
   def timer (self):
     if self.func:
@@ -124,8 +207,8 @@ class Timer (object):
     if self.stopped: return
     try:
       rv = self.timer()
-      if rv is not False:
-        world.doLater(self.seconds, self.timeout)
+      if rv is not False and not self.stopped:
+        self._event = world.doTimerLater(self.seconds, self.timeout)
     except Exception:
       simlog.exception("Exception while executing a timer")
       #traceback.print_exc()
@@ -143,6 +226,82 @@ class OneShot (Timer):
       #traceback.print_exc()
 
 
+class Wait (object):
+  """ Waits for the same things as World.run_until(), but without running
+  the simulation itself.
+  You should just create this with api.wait_until() (and yield it from a
+  tasklet)."""
+  def __init__ (self, predicate = None, max_time = None, idle_for = None):
+    self.predicate = predicate
+    self.max_time = max_time
+    self.idle_for = idle_for
+    self.callback = None
+
+  def start (self, callback):
+    """
+    Starts waiting
+
+    If it's already done, returns why (like run_until()).  Otherwise, this
+    returns None and callback(why) gets called once it's done.  It's checked
+    after each event.
+    """
+    w = world
+    self._end = None
+    if self.max_time is not None:
+      self._end = w._now() + w._units(self.max_time)
+    self._idle = None # When we last went idle
+    self._idle_timer = None
+    self._end_timer = None
+    why = self._check()
+    if why is not None: return why
+
+    self.callback = callback
+    self._hook = w._hook
+    self._next = w._hook or _dispatch
+    w._hook = self.call
+    if self.max_time is not None:
+      self._end_timer = w.doTimerLater(self.max_time, self._wake)
+    return None
+
+  def _check (self):
+    w = world
+    if self.predicate is not None and self.predicate(): return "predicate"
+    now = w._now()
+    if w._in_flight():
+      self._idle = None
+      if self._idle_timer is not None:
+        self._idle_timer.cancel()
+        self._idle_timer = None
+    elif self._idle is None:
+      self._idle = now
+      if self.idle_for:
+        self._idle_timer = w.doTimerLater(self.idle_for, self._wake)
+    if self._idle is not None and now >= self._idle + w._units(self.idle_for
+                                                               or 0):
+      return "idle"
+    if self._end is not None and now >= self._end: return "time"
+    return None
+
+  def call (self, o, m, ev):
+    """
+    Runs an event for the World and then checks whether we're done
+    """
+    self._next(o, m, ev)
+    if self.callback is not None: self._wake()
+
+  def _wake (self):
+    if self.callback is None: return
+    why = self._check()
+    if why is None: return
+    if world._hook == self.call:
+      world._hook = self._hook
+    for t in (self._idle_timer, self._end_timer):
+      if t is not None: t.cancel()
+    callback = self.callback
+    self.callback = None
+    callback(why)
+
+
 world = None
 events = None
 
@@ -153,9 +312,31 @@ class World (object):
     global world
     world = self
 
-    self.queue = Queue.PriorityQueue()
+    # The event heap belongs to the simulation thread; nobody else should
+    # touch it.  Other threads put events in the inbox (appending to a deque
+    # is atomic, so no lock is needed) and then set _wakeup.  The simulation
+    # thread drains the inbox into the heap in batches.
+    # Timers work the same way, except they live in a timing wheel instead
+    # of the heap, which leaves the heap mostly for packet deliveries.
+    self.queue = []
+    self._inbox = deque()
+    self._timer_inbox = deque()
+    self._wakeup = threading.Event()
     self._thread = None
-    self._count = 0
+    self._thread_ident = None # Ident of the thread running the loop
+    self._dead = 0 # Cancelled events in the heap, inbox, or prelist
+
+    # Events at the same time happen in the order of their keys (see
+    # _key()).  These keep track of whose event is running so that the
+    # keys of events it schedules can say where they came from.
+    self._serials = {} # Source -> next number
+    self._current = None # Method of the running event
+    self._current_args = None # And its arguments
+    self._source = None # Source of the running event (None if not known yet)
+    self._count = itertools.count() # Numbers events from other threads
+
+    # Packets waiting to be handed to handle_rx_batch()
+    self._rx_batches = {} # Entity -> [(packet, port), ...]
     self.ended = False
 
     # When the world isn't running, items are put in the prelist.
@@ -172,13 +353,61 @@ class World (object):
 
     self._info = "<No Info!>"
 
-    self._time = 0.0 # For virtual time
+    # Times in the heap and timer wheel (and _time) are in internal units.
+    # Normally these are just seconds (as floats).  If sim.config.tick is
+    # set, they're instead integer numbers of ticks that long (e.g., 1e-9
+    # for nanoseconds), which keeps repeated additions (like recurring
+    # timers or back-to-back packets on a cable) from drifting, and makes
+    # ties exact.  Either way, time (and api.current_time()) is in seconds.
+    # See _now(), _units(), and _seconds().
+    self.tick = sim.config.tick
+    self._per_second = None # Units per second if using ticks
+    wheel_tick = None
+    if self.tick:
+      ps = 1.0 / self.tick
+      if abs(ps - round(ps)) < 1e-6: ps = float(round(ps))
+      self._per_second = ps
+      self._get_time_virtual = self._get_time_ticks
+      wheel_tick = TimerWheel.TICK * ps
+    self._timers = TimerWheel(wheel_tick)
+
+    self._time = 0.0 if self.tick is None else 0 # For virtual time
     self.max_timeout = 10
 
+    # In real time, the clock runs at speed times the wall clock (so 10 is
+    # ten times faster).  It starts at the wall clock time, but after that
+    # it follows the monotonic clock (see speed).
+    self._speed = 1.0
+    self._clock_base = time.time()
+    self._clock_start = _monotonic()
+
+    # How late events run in real time (in simulated seconds), and what to
+    # do if it gets worse than lag_limit.  For catch_up, "burst" runs late
+    # events as fast as possible until caught up, "warn" does the same but
+    # complains about it, and "skip" moves the clock back so that the late
+    # events are on time (i.e., the simulation falls behind the wall clock
+    # rather than hurrying).  See _note_lag().
+    self.lag = 0.0 # For the most recent event
+    self.max_lag = 0.0
+    self.lag_limit = 0.1
+    self.catch_up = "burst"
+    self.skipped = 0.0 # Total seconds skipped by catch_up="skip"
+    self._lag_warned = None
+
     self.trace = False
+    self.profiler = None # Profiler while profiling (see profile())
+    # If set, the loop calls _hook(o, m, ev) to run each event instead of
+    # calling the method itself.  This is for the profiler and the recorder
+    # (which pass events on to whatever hook was there before them, and
+    # eventually to _dispatch()).
+    self._hook = None
+    # If set, TopoNodes call _link_hook(node, port, cable) when a cable is
+    # put on (or taken off) one of their ports.  This is for sim.parallel.
+    self._link_hook = None
+    self._profile = None # Most recent Profiler
     self._running = True
 
-    self.virtual_time = False
+    self.virtual_time = sim.config.virtual_time
 
     import sim.api as api
     api.netvis._a = lambda : _getEntByName(self.a)
@@ -197,6 +426,12 @@ class World (object):
     sim.api.current_time = lambda : self.time
 
     global events
+    events = self._create_interface()
+
+  def _create_interface (self):
+    """
+    Sets up the remote interface (as per the config) and returns it
+    """
     should_sleep = sim.config.interactive
     if sim.config.remote_interface == "tcp":
       import sim.comm_tcp as interface
@@ -207,10 +442,11 @@ class World (object):
     else:
       import sim.comm as interface
       should_sleep = False
-    events = interface.interface()
+    r = interface.interface()
     if should_sleep:
       # Sleep a sec to allow remote to possibly connect
       time.sleep(1)
+    return r
 
   @property
   def virtual_time (self):
@@ -219,7 +455,7 @@ class World (object):
   @virtual_time.setter
   def virtual_time (self, virtual_time):
     extra = "_virtual" if virtual_time else "_real"
-    for attr in "_get_time run".split():
+    for attr in "_get_time _now run".split():
       prefix = "" if attr.startswith("_") else "_"
       setattr(self, attr, getattr(self, prefix+attr+extra))
 
@@ -227,8 +463,71 @@ class World (object):
     self._running = False
 
   def _get_time_real (self):
-    #if self._start_time is None:
-    return time.time()
+    return self._clock_base + (_monotonic() - self._clock_start) * self._speed
+
+  @property
+  def speed (self):
+    """
+    How fast the clock runs compared to the wall clock (in real time)
+    """
+    return self._speed
+
+  @speed.setter
+  def speed (self, speed):
+    speed = float(speed)
+    if speed <= 0: raise ValueError("Speed must be positive")
+    self._clock_base = self._get_time_real()
+    self._clock_start = _monotonic()
+    self._speed = speed
+    self._wakeup.set() # Wait for a different amount of time
+
+  def _note_lag (self, lag):
+    """
+    Called with how late an event is running (in real time)
+    """
+    self.lag = lag
+    if lag > self.max_lag: self.max_lag = lag
+    if lag <= self.lag_limit: return
+    if self.catch_up == "skip":
+      self._clock_base -= lag
+      self.skipped += lag
+      self.lag = 0.0
+    elif self.catch_up == "warn":
+      now = _monotonic()
+      if self._lag_warned is None or now - self._lag_warned > 5:
+        self._lag_warned = now
+        simlog.warning("Simulation is running %.3f seconds behind", lag)
+
+  def _get_time_virtual (self):
+    return self._time
+
+  def _get_time_ticks (self):
+    return self._time / self._per_second
+
+  def _now_real (self):
+    return self._units(self._get_time_real())
+
+  def _now_virtual (self):
+    return self._time
+
+  def _units (self, seconds):
+    """
+    Converts seconds to internal units
+    """
+    ps = self._per_second
+    if ps is None: return seconds
+    try:
+      return int(round(seconds * ps))
+    except (OverflowError, ValueError):
+      return seconds # Infinity
+
+  def _seconds (self, units):
+    """
+    Converts internal units to seconds
+    """
+    ps = self._per_second
+    if ps is None: return units
+    return units / ps
 
   @property
   def time (self):
@@ -247,13 +546,114 @@ class World (object):
     f = self.function_handler.get('selection')
     if f: f(update, selected, unselected, a, b)
 
-  def _real_doLater (_self, _seconds, _method, *_args, **_kw):
-    t = _self.time + _seconds
-    _self._real_doAt(t, _method, *_args, **_kw)
+  def _key (self):
+    """
+    Returns the key for an event the running event is scheduling
+
+    Events at the same time are ordered by their keys, which are
+    (time scheduled, source, number).  The time is _now() (so in real time,
+    it's the clock, not the time of the running event).  The source is the
+    ID of the Entity the running event is for (see _source_of()), and the
+    number counts the events that source has scheduled.  So events
+    scheduled earlier go first, and after that, it doesn't depend on how
+    the events of different Entities happened to be interleaved.  That's
+    what lets sim.parallel run things in the same order as a single process
+    does.
+
+    Only call this from the simulation thread.
+    """
+    src = self._source
+    if src is None:
+      src = self._source = _source_of(self._current, self._current_args)
+    serials = self._serials
+    n = serials.get(src, 0)
+    serials[src] = n + 1
+    return (self._now(), src, n)
+
+  def _schedule (self, t, ev, key = None):
+    """
+    Puts an Event in the heap (or the timer wheel) to happen at time t
+
+    t is in internal units.  key is normally made up by _key().
+    """
+    ev.queued = True
+    if _get_ident() == self._thread_ident:
+      o = (t, key or self._key(), ev)
+      if ev.timer:
+        self._timers.add(o)
+      else:
+        heappush(self.queue, o)
+    else:
+      # From another thread (e.g., the console), so all that's known is
+      # the order they came in
+      o = (t, key or (self._now(), -2, next(self._count)), ev)
+      if ev.timer:
+        self._timer_inbox.append(o)
+      else:
+        self._inbox.append(o)
+      self._wakeup.set()
+    return ev
+
+  COMPACT_MIN = 1000 # Don't bother compacting heaps smaller than this
+
+  def _maybe_compact (self):
+    """
+    Gets rid of cancelled events if they're more than half the heap
+
+    Only call this from the simulation thread.
+    """
+    if self._dead < self.COMPACT_MIN: return
+    if self._dead * 2 < len(self.queue): return
+    # Dead events in the inbox are counted too, so get them in the heap
+    if self._inbox: self._drain_inbox()
+    heap = self.queue
+    live = []
+    for o in heap:
+      if o[2].method is None:
+        o[2].queued = False
+      else:
+        live.append(o)
+    heap[:] = live
+    heapify(heap)
+    self._dead = 0
+
+  def _drain_inbox (self):
+    """
+    Moves events posted by other threads into the heap and timer wheel
+    """
+    inbox = self._inbox
+    heap = self.queue
+    popleft = inbox.popleft
+    while inbox:
+      heappush(heap, popleft())
+
+    inbox = self._timer_inbox
+    popleft = inbox.popleft
+    add = self._timers.add
+    while inbox:
+      add(popleft())
+
+  def _next_time (self):
+    """
+    Returns the time of the next live event (or None if there isn't one)
+
+    The time is in internal units.
 
-  def _real_doAt (_self, _t, _method, *_args, **_kw):
-    _self.queue.put((_t, _self._count, _method, _args, _kw))
-    _self._count += 1
+    Only call this from the simulation thread.
+    """
+    if self._inbox or self._timer_inbox: self._drain_inbox()
+    heap = self.queue
+    while heap and heap[0][2].method is None:
+      heappop(heap)[2].queued = False
+      if self._dead: self._dead -= 1
+    timers = self._timers
+    w = timers.peek()
+    while w is not None and w[2].method is None:
+      timers.pop()[2].queued = False
+      w = timers.peek()
+    o = heap[0] if heap else None
+    if w is not None and (o is None or w < o): o = w
+    return None if o is None else o[0]
 
   @property
   def info (self):
@@ -272,9 +672,7 @@ class World (object):
     assert self._thread is None
     simlog.info("Starting simulation.")
 
-    for a,b,c,d in self._prelist:
-      self._real_doLater(a, b, *c, **d)
-    self._prelist = []
+    self._schedule_prelist()
 
     if threaded:
       self._thread = threading.Thread(target=self.run)
@@ -284,20 +682,119 @@ class World (object):
       self._thread = threading.current_thread()
       self.run()
 
+  def _schedule_prelist (self, now = None):
+    """
+    Moves things scheduled before the start into the queue
+    """
+    if now is None: now = self.time
+    for seconds,ev in self._prelist:
+      if ev.method is None:
+        # Cancelled, which counted it as dead (see Event.cancel())
+        ev.queued = False
+        if not ev.timer and self._dead: self._dead -= 1
+        continue
+      self._schedule(self._units(now + seconds), ev)
+    self._prelist = []
+
   def do (self, _method, *args, **kw):
-    self.doLater(0, _method, *args, **kw)
+    return self.doLater(0, _method, *args, **kw)
 
   def doLater (_self, _seconds, _method, *_args, **_kw):
+    """
+    Calls _method(*_args, **_kw) in _seconds seconds
+
+    Returns an Event, which can be cancelled.
+    """
+    ev = Event(_method, _args, _kw)
     if _self._thread is not None:
-      _self._real_doLater(_seconds, _method, *_args, **_kw)
-    else:
-      _self._prelist.append((_seconds, _method, _args, _kw))
+      return _self._schedule(_self._now() + _self._units(_seconds), ev)
+    _self._prelist.append((_seconds, ev))
+    ev.queued = True
+    return ev
 
   def doAt (_self, _time, _method, *_args, **_kw):
+    ev = Event(_method, _args, _kw)
     if _self._thread is not None:
-      _self._real_doAt(_time, _method, *_args, **_kw)
-    else:
-      _self._prelist.append((_time-_self.time, _method, _args, _kw))
+      return _self._schedule(_self._units(_time), ev)
+    _self._prelist.append((_time-_self.time, ev))
+    ev.queued = True
+    return ev
+
+  def redoAt (self, ev, t, method, *args):
+    """
+    Reuses an Event which has already happened, scheduling it for time t
+
+    This is for things which schedule lots of events (like cables), and
+    which can save some allocations by recycling their own Event objects.
+    The Event must not still be queued, and nobody else should be holding
+    on to it.
+    """
+    return self._redo(ev, self._units(t), method, *args)
+
+  def _redo (self, ev, t, method, *args):
+    """
+    Like redoAt(), but t is in internal units
+    """
+    assert not ev.queued
+    ev.method = method
+    ev.args = args or None
+    ev.kw = None
+    if self._thread is not None:
+      return self._schedule(t, ev)
+    self._prelist.append((self._seconds(t - self._now()), ev))
+    ev.queued = True
+    return ev
+
+  def _redo_keyed (self, ev, t, key, method):
+    """
+    Like _redo() (without arguments), but with the given key
+
+    This is for cables, which schedule deliveries with the keys the
+    packets were sent with.
+    """
+    if self._thread is None: return self._redo(ev, t, method)
+    assert not ev.queued
+    ev.method = method
+    ev.args = ev.kw = None
+    return self._schedule(t, ev, key)
+
+  def doTimerLater (_self, _seconds, _method, *_args, **_kw):
+    """
+    Like doLater(), but for timers
+
+    The event goes into the timer wheel instead of the main event heap.
+    Things which go off periodically (or may well get cancelled before
+    they go off) should use this.
+    """
+    ev = Event(_method, _args, _kw, timer=True)
+    if _self._thread is not None:
+      return _self._schedule(_self._now() + _self._units(_seconds), ev)
+    _self._prelist.append((_seconds, ev))
+    ev.queued = True
+    return ev
+
+  def deliver (self, entity, packet, port):
+    """
+    Hands a received packet to an Entity
+
+    This is what cables call.  Usually, it just calls the Entity's
+    handle_rx().  But if the Entity implements handle_rx_batch(), packets
+    which arrive at the same time are collected and passed to it all at
+    once.  The batch is delivered after all the events which were already
+    scheduled for the current time.
+    """
+    if not _wants_batches(type(entity)):
+      entity.handle_rx(packet, port)
+      return
+    batch = self._rx_batches.get(entity)
+    if batch is None:
+      batch = self._rx_batches[entity] = []
+      self._schedule(self._now(), Event(self._flush_rx, (entity,)))
+    batch.append((packet, port))
+
+  def _flush_rx (self, entity):
+    self._source = _source_of(entity.handle_rx_batch, None)
+    entity.handle_rx_batch(self._rx_batches.pop(entity))
 
   def sleep (self, seconds):
     """
@@ -314,51 +811,298 @@ class World (object):
     self.doAt(time, event.set)
     event.wait()
 
-  def _run_real (self):
-    timeout = None
-    waiting = Queue.PriorityQueue()
+  def _in_flight (self):
+    """
+    Number of non-timer events (mostly packets on the wire) pending
+    """
+    return len(self.queue) - self._dead + len(self._inbox)
 
+  def run_until (self, predicate = None, max_time = None, idle_for = None):
+    """
+    Runs the simulation until it's done, and says why it stopped
+
+    This is meant for scripts and tests, which otherwise have to guess how
+    long to wait.  It returns:
+      "idle"       Once there are no events in flight (or once there have
+                   been none for idle_for seconds).  Timers don't count
+                   (e.g., periodic route advertisements or tasklets which
+                   are sleeping), but pretty much everything else does
+                   (e.g., packets on the wire).
+      "predicate"  Once predicate() returns True (it's checked before each
+                   event).
+      "time"       Once max_time seconds have passed.
+      "stopped"    If the simulation was stopped.
+
+    This runs the simulation on the calling thread, so call it from a
+    script before starting the simulation (in which case this starts it).
+    Calling it from within the simulation runs a loop inside the one which
+    is already running, so tasklets should yield api.wait_until() instead.
+    """
+    if self._thread is None:
+      simlog.info("Starting simulation.")
+      self._thread = threading.current_thread()
+      self._thread_ident = _get_ident()
+      self._schedule_prelist()
+    elif _get_ident() != self._thread_ident:
+      raise RuntimeError("run_until() must be called from the simulation")
+
+    loop = self._loop_virtual if self.virtual_time else self._loop_real
+    end = None if max_time is None else self._now() + self._units(max_time)
+    idle_for = None if idle_for is None else self._units(idle_for)
+    idle = None # When we last went idle
+    while True:
+      if not self._running: return "stopped"
+      if predicate is not None and predicate(): return "predicate"
+      busy = self._in_flight() != 0
+      if busy:
+        idle = None
+      elif idle is None:
+        idle = self._now()
+      if idle is not None and self._now() >= idle + (idle_for or 0):
+        return "idle"
+      if end is not None and self._now() >= end: return "time"
+
+      until = end
+      if idle is not None and (until is None or idle + idle_for < until):
+        until = idle + idle_for
+
+      # Run until we reach until or something changes
+      changed = []
+      def stop ():
+        if (busy != (self._in_flight() != 0)
+            or (predicate is not None and predicate())):
+          changed.append(True)
+          return True
+        return False
+      loop(until=until, stop=stop)
+      if not changed and until is not None and self.virtual_time:
+        # Nothing else happens before until
+        if until > self._time: self._time = until
+
+  def branch (self, n, scenario, run_for=None, collect=None, quiet=True,
+              processes=None):
+    """
+    Tries n what-if scenarios, each starting from the current state
+
+    For each i in range(n), a copy of the simulation is forked off, and
+    scenario(i) is called in it (to, e.g., take down a link).  The copy
+    then runs in virtual time for run_for seconds, or if run_for is None,
+    until there are no more packets in flight.  Then collect(i) is called,
+    and its result (which must be picklable) is sent back.  Returns a list
+    of the results.  If there's no collect, the results are whatever
+    scenario() returned.
+
+    The original simulation is paused while the copies run, and then it
+    picks up where it left off as if nothing happened.  At most processes
+    copies run at once (defaults to the number of CPUs).
+
+    If called from outside the simulation thread (e.g., from the console),
+    and quiet is True, this waits until there are no packets in flight
+    before branching.  If called from within the simulation (e.g., from a
+    tasklet), it branches right away.
+    """
+    if self._thread is None:
+      raise RuntimeError("The simulation hasn't been started")
+    if _get_ident() == self._thread_ident:
+      return self._branch(n, scenario, run_for, collect, processes)
+    if self.ended:
+      raise RuntimeError("The simulation has ended")
+
+    done = threading.Event()
+    box = []
+    def go (why = None):
+      if quiet and Wait().start(go) is None:
+        return # Called again once nothing is in flight
+      try:
+        box.append(self._branch(n, scenario, run_for, collect, processes))
+      except Exception as e:
+        box.append(e)
+      finally:
+        done.set()
+    self.do(go)
+    done.wait()
+    if isinstance(box[0], Exception): raise box[0]
+    return box[0]
+
+  def _branch (self, n, scenario, run_for, collect, processes):
+    """
+    Does the actual work for branch(); call from the simulation thread
+    """
+    import os
+    from multiprocessing import Pipe, cpu_count
+    if processes is None: processes = cpu_count()
+    processes = max(1, processes)
+
+    results = [None] * n
+    running = deque() # (i, pid, connection)
+    def finish ():
+      i, pid, conn = running.popleft()
+      try:
+        ok, r = conn.recv()
+      except EOFError:
+        ok, r = False, "Branch exited unexpectedly"
+      conn.close()
+      os.waitpid(pid, 0)
+      if ok:
+        results[i] = r
+      else:
+        simlog.error("Branch %s failed:\n%s", i, r)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    for i in range(n):
+      if len(running) >= processes: finish()
+      mine, theirs = Pipe()
+      pid = os.fork()
+      if pid == 0:
+        mine.close()
+        for _,_,c in running: c.close()
+        self._run_branch(i, theirs, scenario, run_for, collect)
+      theirs.close()
+      running.append((i, pid, mine))
+    while running: finish()
+    return results
+
+  def _run_branch (self, i, conn, scenario, run_for, collect):
+    """
+    Runs in a forked-off copy of the simulation; never returns
+    """
+    import os
+    global events
+    status = 0
     try:
-      while self._running:
+      try:
+        # Don't talk to the viewer; it's the original's
+        import sim.comm
+        events = sim.comm.NullInterface()
+        self._time = self._now()
+        self.virtual_time = True
+        self._thread_ident = _get_ident()
+
+        r = scenario(i)
+        until = None if run_for is None else self._time + self._units(run_for)
+        stop = (lambda: not self._in_flight()) if run_for is None else None
         try:
-          t = self.time
-          while not waiting.empty():
-            o = waiting.get()
-            if o[0] <= t:
-              self.queue.put(o)
-              timeout = None
-            else:
-              waiting.put(o)
-              o = waiting.get()
-              waiting.put(o)
-              timeout = o[0] - t
-              break
-          #print("World waiting for",timeout)
-
-          o = self.queue.get(True, 5 if timeout is None else timeout)
-        except Exception:
-          #print("empty")
-          continue
+          self._loop_virtual(until=until, stop=stop)
+          if until is not None and self._running and until > self._time:
+            self._time = until # Nothing else happens before the end
+        except SystemExit:
+          pass
+        if collect: r = collect(i)
+        conn.send((True, r))
+      except:
+        conn.send((False, traceback.format_exc()))
+    except:
+      status = 1
+    finally:
+      sys.stdout.flush()
+      sys.stderr.flush()
+      os._exit(status)
+
+  def _run_real (self):
+    self._thread_ident = _get_ident()
+
+    try:
+      self._loop_real()
+    except KeyboardInterrupt:
+      pass
+    except SystemExit:
+      simlog.debug("Simulation stopped")
+      raise
+    except:
+      simlog.exception("Simulation ended due to exception")
+    finally:
+      simlog.debug("Simulation ended")
+      self.ended = True
 
-        t = self.time
-        if o[0] > t:
-          # Hasn't expired yet...
-          #print("recycle")
-          waiting.put(o)
-          o = waiting.get()
-          waiting.put(o)
-          timeout = o[0] - t
+  def _loop_real (self, until = None, stop = None):
+    """
+    The guts of _run_real()
+
+    If until is given (in internal units), this returns once the clock
+    reaches it.  If stop is given, it's called before each event, and this
+    returns once it returns True.
+    """
+    heap = self.queue
+    inbox = self._inbox
+    timer_inbox = self._timer_inbox
+    timers = self._timers
+    wakeup = self._wakeup
+
+    while self._running:
+      if inbox or timer_inbox: self._drain_inbox()
+      if stop is not None and stop(): return
+
+      # The next event is whichever is first of the heads of the heap
+      # and the timer wheel
+      o = heap[0] if heap else None
+      if o is not None and o[2].method is None:
+        # Cancelled
+        heappop(heap)[2].queued = False
+        if self._dead: self._dead -= 1
+        continue
+      w = timers.peek()
+      if w is not None:
+        if w[2].method is None:
+          timers.pop()[2].queued = False
           continue
-        # Expired
-        timeout = None
-        if self.trace:
-          if hasattr(o[2], "__self__"):
-            print(o[2].__self__.__class__.__name__ + "." + o[2].__func__.__name__,end='')
+        if o is None or w < o: o = w
+
+      if o is not None and (until is None or o[0] < until):
+        timeout = o[0] - self._now()
+        if timeout <= 0:
+          # Expired
+          self._note_lag(self._seconds(-timeout))
+          if o is w:
+            timers.pop()
           else:
-            print(o[2],end='')
-          print(o[3],o[4] if len(o[4]) else '')
-        o[2](*o[3],**o[4])
-        self._post_hook()
+            heappop(heap)
+          ev = o[2]
+          m = ev.method
+          ev.method = None
+          ev.queued = False
+          self._current = m
+          self._current_args = ev.args
+          self._source = None
+          if self.trace: self._trace_event(o[0], m, ev)
+          if self._hook is not None:
+            self._hook(o, m, ev)
+          elif ev.kw is not None:
+            m(*(ev.args or ()), **ev.kw)
+          elif ev.args is not None:
+            m(*ev.args)
+          else:
+            m()
+          continue
+      else:
+        timeout = self._units(self.max_timeout)
+      if until is not None:
+        left = until - self._now()
+        if left <= 0: return
+        if left < timeout: timeout = left
+
+      # Nothing to do until the head deadline (or until someone puts
+      # something in the inbox).  We clear the event *before* rechecking
+      # the inbox so that we can't miss a wakeup.
+      wakeup.clear()
+      if inbox or timer_inbox: continue
+      #print("World waiting for",timeout)
+      wakeup.wait(min(self._seconds(timeout) / self._speed, self.max_timeout))
+
+  def _run_virtual (self):
+    """
+    Runs the simulation in virtual time
+
+    Rather than waiting for the wall clock to reach each event, the clock
+    just jumps straight to the time of the next queued event, so the
+    simulation runs as fast as the CPU allows.  If the queue is empty, we
+    block until something (e.g., the console or a remote interface)
+    schedules more work.
+    """
+    self._thread_ident = _get_ident()
+
+    try:
+      self._loop_virtual()
     except KeyboardInterrupt:
       pass
     except SystemExit:
@@ -370,8 +1114,115 @@ class World (object):
       simlog.debug("Simulation ended")
       self.ended = True
 
-  def _post_hook (self):
-    pass
+  def _loop_virtual (self, until = None, stop = None):
+    """
+    The guts of _run_virtual()
+
+    If until is given (in internal units), this returns as soon as the next
+    event is at or after that time (or there are no events at all) instead
+    of waiting around.
+    If stop is given, it's called before each event, and this returns once
+    it returns True.
+    """
+    heap = self.queue
+    inbox = self._inbox
+    timer_inbox = self._timer_inbox
+    timers = self._timers
+    wakeup = self._wakeup
+
+    while self._running:
+      if inbox or timer_inbox: self._drain_inbox()
+      if stop is not None and stop(): return
+
+      o = heap[0] if heap else None
+      w = timers.peek()
+      if w is not None and (o is None or w < o):
+        if until is not None and w[0] >= until:
+          return
+        o = timers.pop()
+      elif o is not None:
+        if until is not None and o[0] >= until:
+          return
+        heappop(heap)
+        if o[2].method is None and self._dead: self._dead -= 1
+      else:
+        if until is not None: return
+        wakeup.clear()
+        if inbox or timer_inbox: continue
+        wakeup.wait(self.max_timeout)
+        continue
+
+      ev = o[2]
+      ev.queued = False
+      m = ev.method
+      if m is None: continue # Cancelled
+      ev.method = None
+
+      # Events scheduled "in the past" don't get to rewind the clock
+      if o[0] > self._time: self._time = o[0]
+
+      self._current = m
+      self._current_args = ev.args
+      self._source = None
+      if self.trace: self._trace_event(o[0], m, ev)
+      if self._hook is not None:
+        self._hook(o, m, ev)
+      elif ev.kw is not None:
+        m(*(ev.args or ()), **ev.kw)
+      elif ev.args is not None:
+        m(*ev.args)
+      else:
+        m()
+
+  @property
+  def queue_depth (self):
+    """
+    Number of events waiting to happen
+
+    This may include some cancelled ones which haven't been cleaned up yet.
+    """
+    return (len(self.queue) - self._dead + len(self._timers)
+            + len(self._inbox) + len(self._timer_inbox))
+
+  def profile (self, enable = True):
+    """
+    Starts (or with enable=False, stops) profiling events
+
+    Starting again resets the numbers.  See sim.profiler.
+    """
+    if self.profiler is not None:
+      self.profiler.detach()
+      self.profiler = None
+    if enable:
+      from sim.profiler import Profiler
+      self.profiler = self._profile = Profiler(self)
+
+  def profile_report (self, limit = 20, sort = "total"):
+    """
+    Prints the results of profiling
+
+    Shows the top limit callbacks, sorted by sort (which is one of the
+    columns, like "count", "total", "max", or "residency").
+    """
+    if self._profile is None:
+      print("Not profiling.  Turn it on with world.profile().")
+      return
+    print(self._profile.report(limit, sort))
+
+  def profile_dump (self, filename):
+    """
+    Writes the results of profiling to a JSON file
+    """
+    if self._profile is None:
+      raise RuntimeError("Not profiling")
+    self._profile.dump(filename)
+
+  def _trace_event (self, t, m, ev):
+    if hasattr(m, "__self__"):
+      print(m.__self__.__class__.__name__ + "." + m.__func__.__name__,end='')
+    else:
+      print(m,end='')
+    print(ev.args or (),ev.kw or '')
 
 
 class TopoNode (object):
@@ -400,8 +1251,51 @@ class TopoNode (object):
     self.ports = [None] * numPorts
     self.growPorts = growPorts
     self.entity = None
+    self._live = [] # Numbers of ports which have cables, in order
+    self._flood = {} # Port not to flood out of (or None) -> cables to flood
+    self._free = list(range(numPorts)) # Heap of empty port numbers
+    self._peers = {} # Port number -> TopoNode at the other end
+    self._neighbors = {} # TopoNode -> port numbers connected to it
     TopoNode.ANY_CREATED = True
 
+  def _set_port (self, index, cable):
+    """
+    Puts a cable (or None) on a port, keeping the indexes up to date
+    """
+    self.ports[index] = cable
+    i = bisect_left(self._live, index)
+    there = i < len(self._live) and self._live[i] == index
+    if cable is None:
+      if there:
+        del self._live[i]
+        heappush(self._free, index)
+    elif not there:
+      self._live.insert(i, index)
+    self._flood.clear()
+
+    peer = self._peers.pop(index, None)
+    if peer is not None:
+      ports = self._neighbors[peer]
+      ports.remove(index)
+      if not ports: del self._neighbors[peer]
+    if cable is not None:
+      self._peers[index] = cable.dst
+      self._neighbors.setdefault(cable.dst, []).append(index)
+
+    if world._link_hook is not None: world._link_hook(self, index, cable)
+
+  def _free_port (self):
+    """
+    Takes the lowest empty port number (or None if there isn't one)
+
+    It's taken out of _free, so put it back if it doesn't get a cable.
+    """
+    free = self._free
+    while free:
+      port = heappop(free)
+      if self.ports[port] is None: return port
+    return None
+
   def linkTo (self, topoEntity, cable = None, fillEmpty = True, latency = None):
     """
     You can specify a cable to use in several ways:
@@ -440,31 +1334,45 @@ class TopoNode (object):
 
     topoEntity = topoOf(topoEntity)
     def getPort (entity):
-      if not fillEmpty or entity.ports.count(None) == 0:
+      port = entity._free_port() if fillEmpty else None
+      if port is None:
         assert self.growPorts
         entity.ports.append(None)
-        return len(entity.ports) - 1
-      return entity.ports.index(None)
+        port = len(entity.ports) - 1
+      return port
 
     assert topoEntity is not self
 
     remotePort = getPort(topoEntity)
     localPort = getPort(self)
 
-    world.doLater(0, events.send_link_up, self.entity.name, localPort,
-             topoEntity.entity.name, remotePort)
+    if _bulk is None:
+      world.doLater(0, events.send_link_up, self.entity.name, localPort,
+               topoEntity.entity.name, remotePort)
+    else:
+      _bulk.links += 1
 
     if cable[0] is not None:
       c = fixCableEnd(cable[0], self, localPort, topoEntity, remotePort)
-      self.ports[localPort] = c
+      self._set_port(localPort, c)
 
-      world.do(_catch, self.entity.handle_link_up, localPort, c.latency)
+      if _bulk is None:
+        world.do(_catch, self.entity.handle_link_up, localPort, c.latency)
+      else:
+        _bulk.link_ups.append((self.entity, localPort, c.latency))
+    else:
+      heappush(self._free, localPort) # Still empty
 
     if cable[1] is not None:
       c = fixCableEnd(cable[1], topoEntity, remotePort, self, localPort)
-      topoEntity.ports[remotePort] = c
+      topoEntity._set_port(remotePort, c)
 
-      world.do(_catch, topoEntity.entity.handle_link_up, remotePort, c.latency)
+      if _bulk is None:
+        world.do(_catch, topoEntity.entity.handle_link_up, remotePort, c.latency)
+      else:
+        _bulk.link_ups.append((topoEntity.entity, remotePort, c.latency))
+    else:
+      heappush(topoEntity._free, remotePort) # Still empty
 
     return (localPort, remotePort)
 
@@ -481,12 +1389,10 @@ class TopoNode (object):
       _catch(other.entity.handle_link_down, otherPort)
       _catch(self.entity.handle_link_down, index)
 
-      other.ports[otherPort] = None
-      self.ports[index] = None
+      other._set_port(otherPort, None)
+      self._set_port(index, None)
 
-    remove = [index for index,value in enumerate(self.ports)
-              if value is not None and value.dst is topoEntity]
-    for index in remove:
+    for index in sorted(self._neighbors.get(topoEntity, ())):
       if right_now:
         world.do(goDown, index)
       else:
@@ -494,11 +1400,7 @@ class TopoNode (object):
 
   def isConnectedTo (self, other):
     other = topoOf(other)
-    for p in self.ports:
-      if p is None: continue
-      if p.dst is other:
-        return True
-    return False
+    return other in self._neighbors
 
   def disconnect (self):
     for p in (port for port in self.ports if port):
@@ -519,46 +1421,217 @@ class TopoNode (object):
     if (packet.src is None):# or (packet.src is NullAddress):
       packet.src = self.entity
 
-    if not isinstance(port, (list,set,tuple)):
-      ports = [port]
-    elif port is None:
-      ports = []
+    if flood:
+      if isinstance(port, (list,set,tuple)):
+        port = set(port)
+        cables = [self.ports[p] for p in self._live if p not in port]
+      else:
+        cables = self._flood.get(port)
+        if cables is None:
+          cables = tuple(self.ports[p] for p in self._live if p != port)
+          self._flood[port] = cables
     else:
-      ports = list(port)
+      if not isinstance(port, (list,set,tuple)):
+        port = [port]
+      cables = []
+      for remote in port:
+        if remote >=0 and remote < len(self.ports):
+          remote = self.ports[remote]
+          if remote is not None:
+            cables.append(remote)
+
+    payload = None
+    if packet._payload is None and cables:
+      # The copies get what they don't have themselves from their payload,
+      # so give them one which won't change if packet does.  (Copies which
+      # are sent again already have one.)
+      payload = _duplicate_packet(packet)
+    for remote in cables:
+      p = _duplicate_packet(packet, payload)
+      remote.transfer(p)
+
+_batching_types = {}
+def _wants_batches (cls):
+  """
+  Does this Entity class implement handle_rx_batch()?
+  """
+  r = _batching_types.get(cls)
+  if r is None:
+    import sim.api as api
+    r = False
+    for c in cls.__mro__:
+      if 'handle_rx_batch' in vars(c):
+        r = c is not api.Entity
+        break
+    _batching_types[cls] = r
+  return r
 
-    if flood:
-      ports = [p for p in  range(0, len(self.ports)) if p not in ports]
 
-    for remote in ports:
-      if remote >=0 and remote < len(self.ports):
-        remote = self.ports[remote]
-        if remote is not None:
-          p = _duplicate_packet(packet)
-          remote.transfer(p)
+def _duplicate_packet (p, payload = None):
+  """
+  Copies a packet to send out of a port
+
+  The copy is a new packet with its own src, dst, ttl, trace, colors, and
+  the fields a subclass lists in its __slots__ (containers are copied).
+  If p is an original packet (not a copy) and payload isn't given, it's a
+  complete copy which doesn't depend on p at all.  Otherwise, fields which
+  are only in the packet's dict (those of subclasses which don't use
+  __slots__) aren't copied; the copy gets them from the payload (see
+  api.Packet.__getattr__()).  That's p's payload if it's a copy (and the
+  new one gets copies of p's own dict), or the given payload, which should
+  be a complete copy of p.
+  """
+  cls = type(p)
+  info = _packet_info.get(cls)
+  if info is None: info = _get_packet_info(cls)
+  extras,dict_fields = info
+  n = cls.__new__(cls)
+  if p._payload is not None:
+    payload = p._payload
+  n._payload = payload
+  n._src = p._src
+  n._dst = p._dst
+  n.ttl = p.ttl
+  n._trace = p._trace
+  for name in extras:
+    v = getattr(p, name, _missing)
+    if v is _missing: continue # Not set on p
+    if isinstance(v, _containers): v = copy.copy(v)
+    setattr(n, name, v)
+  if dict_fields and (payload is None or p._payload is not None):
+    nd = n.__dict__
+    for k,v in p.__dict__.items():
+      if isinstance(v, _containers): v = copy.copy(v)
+      nd[k] = v
+  else:
+    c = p._outer_color
+    if c is not cls._outer_color: n._outer_color = copy.copy(c)
+    c = p._inner_color
+    if c is not cls._inner_color: n._inner_color = copy.copy(c)
+  return n
 
 
-def _duplicate_packet (p):
-  n = type(p).__new__(type(p))
-  for k,v in vars(p).items():
-    if isinstance(v, (dict, tuple, list, set)):
-      setattr(n, k, copy.copy(v))
-    else:
-      setattr(n, k, v)
-  return n
+_containers = (dict, list, set) # Copied by _duplicate_packet()
+_missing = object()
+
+_packet_info = {} # Packet class -> (extra slot names, has dict fields)
+def _get_packet_info (cls):
+  """
+  Works out what _duplicate_packet() needs to know about a Packet class
+
+  That's the names of the slots added by subclasses of Packet and whether
+  any subclass doesn't have __slots__ (so its fields are in the dict).
+  """
+  import sim.api as api
+  extras = []
+  dict_fields = False
+  for c in cls.__mro__:
+    if c is api.Packet or c is object: continue
+    names = vars(c).get('__slots__')
+    if names is None:
+      dict_fields = True
+      continue
+    if isinstance(names, str): names = (names,)
+    for name in names:
+      if name in ('__dict__', '__weakref__'): continue
+      if name.startswith('__') and not name.endswith('__'):
+        name = '_' + c.__name__.lstrip('_') + name
+      extras.append(name)
+  r = _packet_info[cls] = (tuple(extras), dict_fields)
+  return r
+
+
+class EntityID (int):
+  """
+  The number of an Entity
+
+  Entities are numbered as they're created, and Packets hold these instead
+  of the Entities themselves (see entity_ref()).
+  """
+  __slots__ = ()
+
+
+class EntityRegistry (object):
+  """
+  Keeps track of all the Entities
+
+  There is a single instance of this -- core.registry.
 
+  Each Entity gets an EntityID when it's created, which is its index in
+  entities and nodes (its TopoNode).  Once an Entity is removed, its name
+  can be used again and its node is None, but it stays in entities so that
+  packets which refer to it still work.
+
+  If names is set to a dict (boot sets it to the console's variables), each
+  Entity is put in it under its name, so you can use it from the console.
+  """
+  def __init__ (self):
+    self.entities = [] # EntityID -> Entity
+    self.nodes = [] # EntityID -> TopoNode (or None once removed)
+    self.ids = {} # Name -> EntityID
+    self.names = None # Name -> Entity for the console (if wanted)
+
+  def add (self, entity, node):
+    """
+    Adds an Entity and its TopoNode, returning its new EntityID
+    """
+    name = entity.name
+    if name in self.ids:
+      raise NameError(str(name) + " already exists")
+    i = EntityID(len(self.entities))
+    self.entities.append(entity)
+    self.nodes.append(node)
+    self.ids[name] = i
+    if self.names is not None: self.names[name] = entity
+    return i
+
+  def remove (self, i):
+    name = self.entities[i].name
+    if self.ids.get(name) == i:
+      del self.ids[name]
+      if self.names is not None and self.names.get(name) is self.entities[i]:
+        del self.names[name]
+    self.nodes[i] = None
+
+  def node (self, name):
+    """
+    Returns the TopoNode for the Entity with the given name (or None)
+    """
+    i = self.ids.get(name)
+    return None if i is None else self.nodes[i]
+
+  def all_nodes (self):
+    """
+    Returns the TopoNodes of all Entities which haven't been removed
+    """
+    return [n for n in self.nodes if n is not None]
+
+registry = EntityRegistry()
 
-_builtin = sys.modules.get('__builtin__', sys.modules.get('builtins')).__dict__
 
 def _getByName (name):
-  # Ugh.
-  return topoOf(_builtin.get(name, None))
+  return registry.node(name)
 
 def _getEntByName (name):
   t = _getByName(name)
   if not t: return t
   return t.entity
 
-topo = weakref.WeakValueDictionary()
+
+def entity_ref (entity):
+  """
+  Returns the EntityID for entity, or entity itself if it hasn't got one
+  """
+  i = getattr(entity, '_entity_id', None)
+  return entity if i is None else i
+
+def entity_deref (ref):
+  """
+  Turns the result of entity_ref() back into an Entity
+  """
+  return registry.entities[ref] if type(ref) is EntityID else ref
+
+
 def CreateEntity (_name, _kind, *args, **kw):
   """
   Creates an Entity of kind, where kind is an Entity subclass.
@@ -566,7 +1639,7 @@ def CreateEntity (_name, _kind, *args, **kw):
   Additional arguments are pased to the new Entity's __init__().
   Returns the TopoNode containing the new Entity.
   """
-  if _name in _builtin:
+  if _name in registry.ids:
     raise NameError(str(_name) + " already exists")
   import sim.api as api
 
@@ -580,59 +1653,73 @@ def CreateEntity (_name, _kind, *args, **kw):
 
   te = TopoNode(numPorts, growPorts)
   te.entity = e
+  e._topo = te
+  e._entity_id = registry.add(e, te)
 
-  kind = "host" if isinstance(e, api.HostEntity) else "switch"
-  world.do(events.send_entity_up,e.name, kind)
-  simlog.info(e.name+" up!")
-
-  # Add working methods
-  setattr(e, 'get_port_count', lambda : len(te.ports))
-  def send (packet, port=None, flood=False):
-    te.send(packet, port, flood)
-  setattr(e, 'send', send)
-  def set_debug (*args):
-    #print(e.name + ':', ' '.join((str(s) for s in args)))
-    world.do(events.set_debug,e.name, ' '.join((str(s) for s in args)))
-  setattr(e, 'set_debug', set_debug)
-  def log (msg, *args, **kw):
-    if getattr(e, 'NO_LOG', False): return
-    level = getattr(e, 'LOG_LEVEL', "debug")
-    if "level" in kw:
-      level = kw["level"].lower()
-      del kw["level"]
-    if level not in ['debug', 'info', 'warning', 'error', 'critical', 'exception']:
-      level = "debug"
-    func = getattr(userlog, level)
-    msg = "%s:" + str(msg) # Black magic
-    args = tuple([e.name] + list(args))
-    func(msg, *args, **kw)
-  setattr(e, 'log', log)
-
-  for m in ['linkTo', 'unlinkTo', 'disconnect']:
-    setattr(e, m, getattr(te, m))
-
-  def remove ():
-    te.disconnect()
-    world.do(events.send_entity_down,_name)
-    try:
-      del _builtin[_name]
-    except Exception:
-      pass
-  setattr(e, 'remove', remove)
+  if _bulk is None:
+    kind = "host" if isinstance(e, api.HostEntity) else "switch"
+    world.do(events.send_entity_up,e.name, kind)
+    simlog.info(e.name+" up!")
+  else:
+    _bulk.entities += 1
 
-  # Make a global variable with the right name
-  #sys.modules['__main__'].__dict__[_name] = e
-  #sim.__dict__[_name] = e
-  _builtin[_name] = e
-
-  # This is so we can find its TopoNode
-  topo[e] = te
   return e
 
+
+class _Bulk (object):
+  """
+  Keeps track of what's been put off while inside bulk()
+  """
+  def __init__ (self):
+    self.entities = 0
+    self.links = 0
+    self.link_ups = [] # (Entity, port, latency)
+
+  def create (self, kind, names, *args, **kw):
+    """
+    Creates an Entity of the given kind for each name, returning a list
+    """
+    return [kind.create(name, *args, **kw) for name in names]
+
+  def link (self, pairs, cable = None, latency = None):
+    """
+    Links each (a, b) pair, returning a list of (a's port, b's port)
+    """
+    return [a.linkTo(b, cable, latency=latency) for a,b in pairs]
+
+_bulk = None
+
+@contextmanager
+def bulk ():
+  """
+  Builds a topology in bulk (see api.bulk())
+  """
+  global _bulk
+  if _bulk is not None:
+    # Already in one; the outer one takes care of everything
+    yield _bulk
+    return
+  b = _bulk = _Bulk()
+  try:
+    yield b
+  finally:
+    _bulk = None
+    simlog.info("%s entities and %s links up!", b.entities, b.links)
+    world.do(events.send_snapshot)
+    if b.link_ups: world.do(_bulk_link_up, b.link_ups)
+
+def _bulk_link_up (link_ups):
+  """
+  Calls handle_link_up() for a bunch of links (for bulk())
+  """
+  for entity, port, latency in link_ups:
+    world._source = _source_of(entity.handle_link_up, None)
+    _catch(entity.handle_link_up, port, latency)
+
 def topoOf (entity):
   """ Get TopoNode that contains entity.  Students never use this. """
   if type(entity) is TopoNode:
     # We were actually passed a topo object
     return entity
-  t = topo.get(entity, None)
-  return t
+  i = getattr(entity, '_entity_id', None)
+  return None if i is None else registry.nodes[i]
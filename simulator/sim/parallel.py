@@ -0,0 +1,502 @@
+"""
+Runs a simulation across several processes
+
+This is conservative parallel discrete-event simulation.  Once the topology
+has been built, the Entities are split into partitions (one per worker), and
+a worker process is forked for each partition.  Each worker runs the events
+for the Entities it owns.  Packets sent over a cable which crosses to
+another partition are shipped to the worker which owns the other end.
+
+Workers proceed in lockstep windows of simulated time.  A packet can't get
+to another partition any sooner than the smallest latency of the cables
+between partitions (the "lookahead"), so if the earliest pending event
+anywhere is at time T, every worker can safely run everything before
+T + lookahead without hearing from anyone else.  The parent process just
+coordinates this and passes packets between workers.
+
+This only works in virtual time, and it only pays off when there are lots
+of Entities and the links between partitions have decent latency.  Some
+other things to be aware of:
+
+ * Events not tied to any Entity (e.g., tasklets in test scripts and
+   topology changes) run in every worker.  When they try to make an Entity
+   the worker doesn't own send something, nothing happens (the owner does
+   the sending).  But they only see the state of the Entities owned by
+   their own worker, so have tests get their answers using collect (see
+   run()).
+ * Entities should all be created before the run starts.
+ * Events at exactly the same time run in the order of their keys (see
+   World._key()), which don't depend on how things are partitioned, so
+   everything happens in the same order as in a single process.  Except:
+   the workers each have their own random number generator, so things
+   which use it while running (like UnreliableCable or DV routers with
+   RANDOMIZE_TIMERS) will go differently.  Same for cables with a
+   queue_size, since which packets get dropped depends on when the far end
+   finds out about them.
+ * The GUI isn't supported -- workers don't talk to it.
+
+Run from the commandline like:
+  ./simulator.py --virtual-time --no-interactive topos.rand --switches=100
+      sim.parallel --workers=4 --until=300
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import pickle
+import itertools
+from io import BytesIO
+from collections import deque
+from multiprocessing import Pipe
+
+import sim.core as core
+import sim.comm as comm
+from sim.core import simlog
+
+try:
+  from threading import get_ident as _get_ident
+except ImportError:
+  from thread import get_ident as _get_ident
+
+
+class _Pickler (pickle.Pickler):
+  """ Pickles Entities as just their names """
+  def persistent_id (self, obj):
+    import sim.api as api
+    if isinstance(obj, api.Entity):
+      return obj.name
+    return None
+
+class _Unpickler (pickle.Unpickler):
+  """ Turns Entity names back into the (local copy of the) Entities """
+  def persistent_load (self, pid):
+    return core._getEntByName(pid)
+
+def _dumps (obj):
+  f = BytesIO()
+  _Pickler(f, pickle.HIGHEST_PROTOCOL).dump(obj)
+  return f.getvalue()
+
+def _loads (data):
+  return _Unpickler(BytesIO(data)).load()
+
+
+def _entity_id (te):
+  return te.entity._entity_id
+
+
+def partition (nodes, count):
+  """
+  Splits TopoNodes into count groups with about the same amount of work
+
+  Most of the work is handling packets, so a node's share is roughly its
+  number of links.  Each group is grown breadth-first, so neighbors mostly
+  wind up together and few links cross between groups.  Returns a dict
+  from TopoNode to group number.
+  """
+  def weight (node):
+    return 1 + sum(1 for c in node.ports if c is not None)
+  target = sum(weight(n) for n in nodes) / float(count)
+  parts = {}
+  part = 0
+  size = 0
+  for seed in nodes:
+    if seed in parts: continue
+    frontier = deque([seed])
+    while frontier:
+      node = frontier.popleft()
+      if node in parts: continue
+      if size >= target and part < count - 1:
+        # This group is full; start the next one from here
+        part += 1
+        size = 0
+        frontier.clear()
+      parts[node] = part
+      size += weight(node)
+      for c in node.ports:
+        if c is not None and c.dst not in parts:
+          frontier.append(c.dst)
+  return parts
+
+
+def _min_latency (cable):
+  """
+  The soonest a packet sent on cable can get to the other end
+
+  This is in the World's internal units (like BasicCable.transfer() uses).
+  """
+  world = core.world
+  return world._units(cable.latency) + world._units(getattr(cable, 'tx_time', 0))
+
+
+def _no_send (packet, port, flood = False):
+  """ Sends from Entities owned by other workers go nowhere """
+  pass
+
+
+class _Worker (object):
+  """
+  The part of the simulation that runs in a worker process
+  """
+  def __init__ (self, index, conn, owners, lookahead, collect):
+    self.world = core.world
+    self.index = index
+    self.conn = conn
+    self.owners = owners # Entity ID -> partition
+    self.owned = set(k for k,v in owners.items() if v == index)
+    self.lookahead = lookahead
+    self.collect = collect
+    self.outbox = {} # partition -> [message]
+    self._count = itertools.count()
+    self._warned = False
+
+  def serve (self):
+    world = self.world
+    conn = self.conn
+    self._setup()
+    try:
+      self._serve()
+    finally:
+      self._teardown()
+
+  def _serve (self):
+    world = self.world
+    conn = self.conn
+    conn.send(('ready', world._next_time()))
+    while True:
+      msg = conn.recv()
+      if msg[0] == 'run':
+        self._inject(msg[2])
+        stopped = False
+        try:
+          world._loop_virtual(until=msg[1])
+          stopped = not world._running
+        except SystemExit:
+          stopped = True
+        except Exception:
+          simlog.exception("Worker %s ended due to exception", self.index)
+          stopped = True
+        out = {}
+        for dest,messages in self.outbox.items():
+          if messages:
+            out[dest] = (messages[0][0], _dumps(messages))
+        self.outbox.clear()
+        conn.send(('done', world._next_time(), out, stopped))
+      elif msg[0] == 'collect':
+        r = None
+        if self.collect:
+          owned = self.owned
+          entities = [te.entity for te in core.registry.all_nodes()
+                      if _entity_id(te) in owned]
+          entities.sort(key=lambda e: e.name)
+          r = self.collect(entities)
+        conn.send(r)
+      else:
+        return
+
+  def _setup (self):
+    world = self.world
+    world._thread_ident = _get_ident()
+    core.events = comm.NullInterface()
+
+    # Only schedule events for Entities we own
+    owned = self.owned
+    self._schedule = world.__dict__.get('_schedule') # To put back after
+    schedule = world._schedule
+    here = {} # Entity or Cable -> whether its events run here
+    def _schedule (t, ev, key = None):
+      m = ev.method
+      if m is core._bulk_link_up:
+        # Just the links of our own Entities
+        ev.args = ([l for l in ev.args[0] if l[0]._entity_id in owned],)
+        return schedule(t, ev, key)
+      obj = getattr(m, '__self__', None)
+      r = here.get(obj) if obj is not None else None
+      if r is None and m is not None:
+        if isinstance(obj, comm.NullInterface):
+          # Viewer updates.  These were bound to the real interface before
+          # the fork, so don't let them run.
+          r = False
+        else:
+          owner = core._source_of(m, ev.args)
+          r = owner == -1 or owner in owned
+          if owner != -1 and not isinstance(obj, core.Timer): here[obj] = r
+      if r is False:
+        ev.queued = False
+        return ev
+      return schedule(t, ev, key)
+    world._schedule = _schedule
+
+    # Entities owned by other workers don't send anything (their owners
+    # do), and packets for other partitions go to their workers
+    self._muted = []
+    for te in core.registry.all_nodes():
+      self._check_node(te)
+    world._link_hook = self._check_link
+
+    # Pick through everything scheduled so far.  These all keep their keys.
+    pending = list(world._inbox) + list(world._timer_inbox) + world.queue
+    world._inbox.clear()
+    world._timer_inbox.clear()
+    del world.queue[:]
+    world._dead = 0
+    pending.sort(key=lambda o: o[:2])
+    for o in pending:
+      if o[2].method is not None:
+        world._schedule(o[0], o[2], o[1])
+
+  def _teardown (self):
+    world = self.world
+    if self._schedule is None:
+      del world._schedule
+    else:
+      world._schedule = self._schedule
+    world._link_hook = None
+    for te in self._muted:
+      del te.send
+
+  def _check_node (self, te):
+    """
+    Mutes a node we don't own, or hooks up its cables to other workers
+    """
+    if _entity_id(te) not in self.owned:
+      if 'send' not in vars(te):
+        te.send = _no_send
+        self._muted.append(te)
+      return
+    for c in te.ports:
+      if c is not None: self._check_cable(c)
+
+  def _check_link (self, te, port, cable):
+    if cable is None: return
+    if _entity_id(te) in self.owned:
+      self._check_cable(cable)
+    else:
+      self._check_node(te)
+
+  def _check_cable (self, cable):
+    if 'transfer' in vars(cable): return # Already sends to another worker
+    if cable.dstEnt._entity_id not in self.owned:
+      self._make_remote(cable)
+
+  def _make_remote (self, cable):
+    """
+    Makes a cable send packets to the worker at the other end
+    """
+    dest = self.owners.get(cable.dstEnt._entity_id)
+    if dest is None: return # Never heard of it; stays local
+    if _min_latency(cable) < self.lookahead and not self._warned:
+      self._warned = True
+      simlog.warning("Link from %s to %s is faster than the lookahead; "
+                     "results may be wrong", cable.srcEnt, cable.dstEnt)
+    outbox = self.outbox
+    world = self.world
+    index = self.index
+    count = self._count
+    def transfer (packet):
+      m = (world._time, index, next(count), world._key(), cable.srcEnt.name,
+           cable.srcPort, packet)
+      outbox.setdefault(dest, []).append(m)
+    cable.transfer = transfer
+
+  def _inject (self, blobs):
+    """
+    Puts packets from other workers onto our ends of their cables
+
+    The transfer happens as of the time the packet was sent, and with the
+    key the sender's World gave it, so it gets delivered when (and in the
+    same order as) it would have been if we were all in one process.
+    Since all cables between partitions are at least the lookahead long,
+    that's never before the start of the current window.  Packets go onto
+    each cable in the order they were sent.
+    """
+    if not blobs: return
+    messages = []
+    for _,blob in blobs:
+      messages.extend(_loads(blob))
+    messages.sort(key=lambda m: m[:3])
+    world = self.world
+    serials = world._serials
+    now = world._time
+    try:
+      for t,_,_,key,src,port,packet in messages:
+        te = core._getByName(src)
+        cable = te.ports[port] if te and port < len(te.ports) else None
+        if cable is None: continue # Link went away
+        # Set things up so that the key the transfer gets is the one the
+        # packet was sent with
+        _,source,n = key
+        old = serials.get(source)
+        world._time = t
+        world._source = source
+        serials[source] = n
+        try:
+          cable.transfer(packet)
+        finally:
+          if old is None:
+            del serials[source]
+          else:
+            serials[source] = old
+    finally:
+      world._time = now
+      world._current = world._source = None
+
+
+def _coordinate (workers = 2, until = None, lookahead = None, collect = None,
+                 partition = partition):
+  """
+  Forks the workers and keeps them in step
+
+  Returns a list with the result of collect from each worker.
+  """
+  world = core.world
+  if not world.virtual_time:
+    raise RuntimeError("Parallel simulation only works in virtual time")
+
+  nodes = sorted(core.registry.all_nodes(), key=lambda te: te.entity.name)
+  workers = max(1, min(int(workers), len(nodes)))
+  parts = partition(nodes, workers)
+  owners = dict((_entity_id(te), parts[te]) for te in nodes)
+
+  # The lookahead is the quickest way from one partition to another
+  limit = float("inf")
+  for te in nodes:
+    for c in te.ports:
+      if c is None: continue
+      if parts[te] != parts.get(c.dst):
+        limit = min(limit, _min_latency(c))
+  if lookahead is None:
+    lookahead = limit
+  else:
+    lookahead = world._units(float(lookahead))
+    if lookahead > limit:
+      raise RuntimeError("Lookahead can't be more than %s"
+                         % (world._seconds(limit),))
+  if lookahead <= 0:
+    raise RuntimeError("Can't run in parallel when links between partitions "
+                       "have no latency")
+  if until is not None: until = world._units(until)
+
+  simlog.info("Running %s nodes on %s workers (lookahead %s)",
+              len(nodes), workers, world._seconds(lookahead))
+
+  sys.stdout.flush()
+  sys.stderr.flush()
+  conns = []
+  pids = []
+  for index in range(workers):
+    mine, theirs = Pipe()
+    pid = os.fork()
+    if pid == 0:
+      status = 0
+      try:
+        for c in conns: c.close()
+        mine.close()
+        _Worker(index, theirs, owners, lookahead, collect).serve()
+      except:
+        simlog.exception("Worker %s failed", index)
+        status = 1
+      finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+    theirs.close()
+    conns.append(mine)
+    pids.append(pid)
+
+  try:
+    times = [c.recv()[1] for c in conns]
+    pending = [[] for _ in conns] # (earliest send time, pickled messages)
+    rounds = 0
+    now = world._time
+    while True:
+      bound = [t for t in times if t is not None]
+      bound.extend(b[0] + lookahead for p in pending for b in p)
+      if not bound: break
+      start = min(bound)
+      if until is not None and start >= until: break
+      end = start + lookahead
+      if until is not None and end > until: end = until
+
+      for i,c in enumerate(conns):
+        c.send(('run', end, pending[i]))
+        pending[i] = []
+      stopped = False
+      for i,c in enumerate(conns):
+        _, times[i], out, s = c.recv()
+        if s: stopped = True
+        for dest,blob in out.items():
+          pending[dest].append(blob)
+      rounds += 1
+      now = max(now, start)
+      if stopped: break
+
+    results = []
+    for c in conns:
+      c.send(('collect',))
+      results.append(c.recv())
+  finally:
+    for c in conns:
+      try:
+        c.send(('exit',))
+      except Exception:
+        pass
+      c.close()
+    for pid in pids:
+      os.waitpid(pid, 0)
+
+  world._time = now
+  world.ended = True
+  simlog.info("Parallel simulation finished after %s rounds", rounds)
+  return results
+
+
+def run (workers = 2, until = None, lookahead = None, collect = None,
+         partition = partition):
+  """
+  Starts the simulation split up across worker processes
+
+  Call this instead of world.start() once the topology is built.  It
+  returns when the simulation ends (when until is reached, when there's
+  nothing left to do, or when something in a worker calls sys.exit()).
+
+  collect is a function which gets called in each worker at the end with a
+  list of the Entities that worker owned.  Its return values (which need
+  to be picklable) are returned in a list.
+
+  partition is a function which takes a list of TopoNodes and a number of
+  workers and returns a dict mapping each TopoNode to a worker number.
+  lookahead defaults to the lowest latency of any link between partitions.
+  """
+  results = []
+  def go ():
+    results.extend(_coordinate(workers, until, lookahead, collect, partition))
+  core.world.run = go
+  core.world.start(threaded=False)
+  return results
+
+
+results = None # What collect returned in each worker for launch()
+
+def launch (workers = 2, until = None, lookahead = None, collect = None):
+  """
+  Makes the simulation run in parallel when it starts
+
+  Needs --virtual-time.  collect is as for run() (and can also be the name
+  of a function, like "mymodule.collect").  Once the simulation ends, what
+  it returned in each worker is in results.
+  """
+  import sim
+  if not sim.config.virtual_time:
+    raise RuntimeError("sim.parallel needs --virtual-time")
+  if until is not None: until = float(until)
+  if lookahead is not None: lookahead = float(lookahead)
+  if isinstance(collect, str):
+    module,name = collect.rsplit(".", 1)
+    __import__(module)
+    collect = getattr(sys.modules[module], name)
+  def go ():
+    global results
+    results = _coordinate(int(workers), until, lookahead, collect)
+  core.world.run = go
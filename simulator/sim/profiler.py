@@ -0,0 +1,167 @@
+"""
+Profiles what the World spends its time on
+
+Turn it on from the console with world.profile() (or start the simulator
+with --profile), and see the results with world.profile_report().  They
+can also be written out as JSON with world.profile_dump(filename).
+
+Events are grouped by their callback's class and method (for example,
+BasicCable.deliver or DVRouter.handle_timer), and for each, the profiler
+records how many times it ran, how much wall clock time it took (total and
+max), and how long events sat in the queue (in simulated time) between
+being scheduled and running.  Events which were scheduled before profiling
+started don't count toward the queue time.
+
+When profiling is off, the World doesn't do any of this, so it costs next
+to nothing.
+"""
+
+from __future__ import print_function
+
+import json
+from timeit import default_timer as _timer
+
+import sim.core as core
+
+
+_names = {} # (class, function) or function -> name
+
+def callback_name (m, args = None):
+  """
+  Returns a name for an event's method, like "BasicCable.deliver"
+
+  Methods of the remote interface are all called "events.<method>" so that
+  the name doesn't depend on which interface is in use.
+  """
+  if m is core._catch and args:
+    m = args[0]
+  obj = getattr(m, '__self__', None)
+  func = getattr(m, '__func__', m)
+  k = func if obj is None else (type(obj), func)
+  name = _names.get(k)
+  if name is None:
+    name = getattr(func, '__qualname__', None)
+    if name is None: name = getattr(func, '__name__', None) or repr(func)
+    if obj is not None:
+      name = name.rsplit(".", 1)[-1]
+      if obj is core.events:
+        name = "events." + name
+      else:
+        name = type(obj).__name__ + "." + name
+    _names[k] = name
+  return name
+
+
+class Profiler (object):
+  COLUMNS = ("count", "total", "max", "residency", "max_residency", "queued")
+
+  def __init__ (self, world):
+    self.world = world
+    self.stats = {} # name -> [count, total, max, residency, max_residency,
+                    #          number of events residency is for]
+    self.events = 0
+    self.max_depth = 0
+    self._started = _timer()
+
+    # Note when events are scheduled
+    self._schedule = world.__dict__.get('_schedule')
+    schedule = world._schedule
+    def _schedule (t, ev, key = None):
+      ev.born = world.time
+      return schedule(t, ev, key)
+    world._schedule = _schedule
+
+    self._hook = world._hook
+    self._next = world._hook or core._dispatch
+    world._hook = self.call
+
+  def detach (self):
+    """
+    Stops noting when events get scheduled or run
+    """
+    if self._schedule is None:
+      del self.world._schedule
+    else:
+      self.world._schedule = self._schedule
+    if self.world._hook == self.call:
+      self.world._hook = self._hook
+
+  def call (self, o, m, ev):
+    """
+    Runs an event for the World, keeping track of how it went
+    """
+    name = callback_name(m, ev.args)
+    s = self.stats.get(name)
+    if s is None:
+      s = self.stats[name] = [0, 0.0, 0.0, 0.0, 0.0, 0]
+    born = getattr(ev, 'born', None)
+    if born is not None:
+      r = self.world.time - born
+      s[3] += r
+      if r > s[4]: s[4] = r
+      s[5] += 1
+    depth = len(self.world.queue)
+    if depth > self.max_depth: self.max_depth = depth
+
+    start = _timer()
+    try:
+      self._next(o, m, ev)
+    finally:
+      took = _timer() - start
+      s[0] += 1
+      s[1] += took
+      if took > s[2]: s[2] = took
+      self.events += 1
+
+  def summary (self):
+    """
+    Returns the results as a dict (which is what dump() writes)
+    """
+    world = self.world
+    callbacks = {}
+    for name,s in self.stats.items():
+      callbacks[name] = dict(zip(self.COLUMNS, s))
+    return {
+      'events' : self.events,
+      'seconds' : _timer() - self._started,
+      'callbacks' : callbacks,
+      'histogram' : dict((name, s[0]) for name,s in self.stats.items()),
+      'queue' : {
+        'depth' : world.queue_depth,
+        'heap' : len(world.queue),
+        'cancelled' : world._dead,
+        'timers' : len(world._timers),
+        'max_heap' : self.max_depth,
+      },
+    }
+
+  def dump (self, filename):
+    with open(filename, "w") as f:
+      json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+  def report (self, limit = 20, sort = "total"):
+    """
+    Returns the results as a table
+    """
+    col = self.COLUMNS.index(sort)
+    items = sorted(self.stats.items(), key=lambda x: x[1][col], reverse=True)
+    q = self.summary()['queue']
+    busy = sum(s[1] for s in self.stats.values())
+    lines = []
+    lines.append("%s events in %.3fs (%.3fs running them)"
+                 % (self.events, _timer() - self._started, busy))
+    lines.append("Queue: %(depth)s pending, %(heap)s in heap (max %(max_heap)s),"
+                 " %(cancelled)s cancelled, %(timers)s timers" % q)
+    lines.append("%-40s %9s %9s %6s %9s %9s %9s"
+                 % ("Callback", "Count", "Total s", "%", "Mean us", "Max ms",
+                    "Queued s"))
+    for name,s in items[:limit]:
+      count,total,most,residency,_,queued = s
+      lines.append("%-40s %9s %9.3f %6.1f %9.1f %9.3f %9.3f"
+                   % (name[-40:], count, total,
+                      100.0 * total / busy if busy else 0,
+                      1e6 * total / count if count else 0, 1e3 * most,
+                      residency / queued if queued else 0))
+    if len(items) > limit:
+      lines.append("(%s more)" % (len(items) - limit,))
+    return "\n".join(lines)
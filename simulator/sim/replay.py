@@ -0,0 +1,344 @@
+"""
+Records a run so that it can be replayed exactly
+
+Start the simulator with --record=FILE to record a run, and then run it
+again with the same modules and options plus --replay=FILE to replay it.
+Add --replay-stop=N to stop after the first N events (e.g., just before
+something goes wrong), at which point you can poke around at the console.
+
+The recording has the state of the random number generator at the start
+and the callback and time of every event the World runs, which is enough
+to make the replay run the same events in the same order.  Input which
+comes from the remote interface (e.g., pings and link changes from NetVis)
+is recorded along with the event it arrived at and is fed back in at the
+same point during the replay.  Replays always run in virtual time, so they
+run as fast as they can even when the recording was in real time.  While
+recording a real time run, the time seen by each event is the time at which
+it started (so that the replay sees exactly the same times).
+
+If an event in the replay doesn't match the recording, the replay stops
+with an error.  Things which can make this happen:
+* Running with different modules or options
+* Doing things from the console while recording (use the remote interface
+  or a tasklet instead)
+* Code which depends on the order of sets of strings -- run both with the
+  same PYTHONHASHSEED if the error says string hashes differ
+* On Python 2, code which loops over dicts or sets of objects (like the DV
+  router's table, which is keyed by host), since their order depends on
+  where the objects happen to be in memory
+
+The file starts with MAGIC and a pickled header (preceded by its length as
+a varint).  After that, records are a byte saying what kind it is followed
+by its fields:
+  NAME   length, utf8 name       Gives the next name number to a callback
+  EVENT  time, name              An event
+  SAME   name                    An event at the same time as the last one
+  START  double time             The World started (prelist scheduled)
+  INPUT  time, length,           Input from the remote interface (the
+         pickled (module, class, method, kwargs)) handler is an event too)
+Numbers are varints and doubles are little-endian.  Event and input times
+are in the World's internal units (see World._units()): doubles normally,
+or zig-zag varints (like protobuf's sint64, but any size) with --tick
+(since real time in nanoseconds is too big for a double to hold exactly).
+START is seconds.
+"""
+
+import atexit
+import pickle
+import random
+import struct
+import sys
+
+import sim.core as core
+from sim.core import simlog, _get_ident
+import sim.comm as comm
+from sim.profiler import callback_name
+
+
+MAGIC = b"SIMREC1\n"
+
+NAME, EVENT, SAME, START, INPUT = range(5)
+
+_double = struct.Struct("<d")
+
+_FINGERPRINT = "sim.replay" # Hashed to see if PYTHONHASHSEED matches
+
+
+def _varint (n):
+  out = bytearray()
+  while n >= 0x80:
+    out.append((n & 0x7f) | 0x80)
+    n >>= 7
+  out.append(n)
+  return bytes(out)
+
+
+def _read_varint (f):
+  n = 0
+  shift = 0
+  while True:
+    b = f.read(1)
+    if not b: raise EOFError()
+    b = bytearray(b)[0]
+    n |= (b & 0x7f) << shift
+    if not (b & 0x80): return n
+    shift += 7
+
+
+def _zigzag (n):
+  return _varint(n << 1 if n >= 0 else (-n << 1) - 1)
+
+
+def _read_zigzag (f):
+  n = _read_varint(f)
+  return (n >> 1) ^ -(n & 1)
+
+
+def _read_double (f):
+  d = f.read(8)
+  if len(d) != 8: raise EOFError()
+  return _double.unpack(d)[0]
+
+
+def _time_format (tick):
+  """ Returns functions to write and read event times """
+  if tick is None: return _double.pack, _read_double
+  return _zigzag, _read_zigzag
+
+
+def _is_input (m):
+  obj = getattr(m, '__self__', None)
+  return (isinstance(obj, comm.NullInterface)
+          and m.__name__.startswith("_handle_"))
+
+
+def _options (argv):
+  """ Returns commandline arguments without the ones for this module """
+  return [a for a in argv if not a.startswith(("--record", "--replay"))]
+
+
+class ReplayError (RuntimeError):
+  pass
+
+
+class Recorder (object):
+  """
+  Writes events the World runs to a file
+  """
+  def __init__ (self, world, filename):
+    self.world = world
+    self.filename = filename
+    self.count = 0
+    self._names = {}
+    self._last = None
+    self._f = open(filename, "wb")
+    self._write = self._f.write
+    self._pack_time = _time_format(world.tick)[0]
+
+    header = dict(argv = _options(sys.argv[1:]),
+                  virtual_time = world.virtual_time,
+                  time = world.time,
+                  tick = world.tick,
+                  random = random.getstate(),
+                  hash = hash(_FINGERPRINT))
+    header = pickle.dumps(header, 2)
+    self._write(MAGIC + _varint(len(header)) + header)
+
+    sched = world._schedule_prelist
+    def _schedule_prelist (now = None):
+      if now is None: now = world.time
+      self._write(bytes(bytearray([START])) + _double.pack(now))
+      sched(now)
+    world._schedule_prelist = _schedule_prelist
+
+    self._next = world._hook or core._dispatch
+    world._hook = self.call
+    atexit.register(self.close)
+
+  def close (self):
+    if self._f.closed: return
+    self._f.close()
+    simlog.info("Recorded %s events to %s", self.count, self.filename)
+
+  def call (self, o, m, ev):
+    """
+    Records an event and runs it
+    """
+    world = self.world
+    if world.virtual_time:
+      self._record(world._time, m, ev)
+      self._next(o, m, ev)
+      return
+
+    # Hold the time still while the event runs
+    t = world._time = world._now_real()
+    self._record(t, m, ev)
+    world._get_time = world._get_time_virtual
+    world._now = world._now_virtual
+    try:
+      self._next(o, m, ev)
+    finally:
+      world._get_time = world._get_time_real
+      world._now = world._now_real
+
+  def _record (self, t, m, ev):
+    if self._f.closed: return
+    w = self._write
+    name = callback_name(m, ev.args)
+    i = self._names.get(name)
+    if i is None:
+      i = self._names[name] = len(self._names)
+      n = name.encode("utf8")
+      w(bytes(bytearray([NAME])) + _varint(len(n)) + n)
+    if _is_input(m):
+      cls = type(m.__self__)
+      data = pickle.dumps((cls.__module__, cls.__name__, m.__name__,
+                           ev.kw or {}), 2)
+      w(bytes(bytearray([INPUT])) + self._pack_time(t) + _varint(len(data))
+        + data)
+      self._last = None
+    elif t == self._last:
+      w(bytes(bytearray([SAME])) + _varint(i))
+    else:
+      w(bytes(bytearray([EVENT])) + self._pack_time(t) + _varint(i))
+      self._last = t
+    self.count += 1
+
+
+class Replayer (object):
+  """
+  Makes the World run the events in a recording
+  """
+  def __init__ (self, world, filename, stop_at = None):
+    self.world = world
+    self.filename = filename
+    self.stop_at = stop_at
+    self.count = 0 # Events run so far
+    self._names = []
+    self._time = None
+    self._f = open(filename, "rb")
+    if self._f.read(len(MAGIC)) != MAGIC:
+      raise ReplayError("%s is not a recording" % (filename,))
+    header = pickle.loads(self._f.read(_read_varint(self._f)))
+
+    if header['argv'] != _options(sys.argv[1:]):
+      simlog.warning("Recording was made with different options: %s",
+                     " ".join(header['argv']))
+    self._same_hash = header['hash'] == hash(_FINGERPRINT)
+    tick = header.get('tick')
+    if tick != world.tick:
+      raise ReplayError("Recording was made with tick=%s but this is %s"
+                        % (tick, world.tick))
+    self._read_time = _time_format(tick)[1]
+    random.setstate(header['random'])
+
+    world.virtual_time = True
+    world._time = world._units(header['time'])
+    self._rec = self._read()
+
+    sched = world._schedule_prelist
+    def _schedule_prelist (now = None):
+      if self._rec is not None and self._rec[0] == START:
+        now = self._rec[1]
+        world._time = world._units(now)
+        self._rec = self._read()
+      sched(now)
+    world._schedule_prelist = _schedule_prelist
+
+    self._next = world._hook or core._dispatch
+    world._hook = self.call
+    world.run = self.run
+
+  def _read (self):
+    """
+    Returns the next record (kind, time, name or input) or None at the end
+    """
+    f = self._f
+    try:
+      while True:
+        kind = f.read(1)
+        if not kind: return None
+        kind = bytearray(kind)[0]
+        if kind == NAME:
+          self._names.append(f.read(_read_varint(f)).decode("utf8"))
+        elif kind == SAME:
+          return (EVENT, self._time, self._names[_read_varint(f)])
+        elif kind == EVENT:
+          self._time = self._read_time(f)
+          return (EVENT, self._time, self._names[_read_varint(f)])
+        elif kind == START:
+          return (START, _read_double(f), None)
+        elif kind == INPUT:
+          t = self._read_time(f)
+          self._time = None
+          return (INPUT, t, pickle.loads(f.read(_read_varint(f))))
+        else:
+          raise ReplayError("Bad record in %s" % (self.filename,))
+    except EOFError:
+      simlog.warning("Recording %s ends partway through a record",
+                     self.filename)
+      return None
+
+  def run (self):
+    world = self.world
+    world._thread_ident = _get_ident()
+    try:
+      world._loop_virtual(until=float("inf"), stop=self._before)
+    except KeyboardInterrupt:
+      pass
+    except SystemExit:
+      simlog.debug("Replay stopped")
+      raise
+    except ReplayError as e:
+      simlog.error("%s", e)
+      if not self._same_hash:
+        simlog.error("String hashes differ from the recording; try setting "
+                     "PYTHONHASHSEED to the same thing for both")
+    except Exception:
+      simlog.exception("Replay ended due to exception")
+    finally:
+      simlog.info("Replayed %s events (time is %s)", self.count, world.time)
+      world.ended = True
+
+  def _input (self, t, data):
+    module,cls,method,kw = data
+    __import__(module)
+    cls = getattr(sys.modules[module], cls)
+    m = getattr(cls.__new__(cls), method)
+    world = self.world
+    world._time = t
+    world._current = m # So that what it schedules gets the right keys
+    world._current_args = None
+    world._source = None
+    self.count += 1
+    m(**kw)
+
+  def _before (self):
+    """
+    Feeds in input which comes next and says whether to stop
+    """
+    while True:
+      if self.stop_at is not None and self.count >= self.stop_at:
+        simlog.info("Stopping replay at event %s", self.count)
+        return True
+      rec = self._rec
+      if rec is None:
+        simlog.info("End of recording")
+        return True
+      if rec[0] != INPUT: return False
+      self._rec = self._read()
+      self._input(rec[1], rec[2])
+
+  def call (self, o, m, ev):
+    """
+    Checks an event against the recording and runs it
+    """
+    name = callback_name(m, ev.args)
+    rec = self._rec
+    if rec is None or rec[0] != EVENT or rec[2] != name:
+      raise ReplayError("Replay diverged at event %s: expected %s but got %s"
+                        % (self.count, rec[2] if rec else "nothing", name))
+    self._rec = self._read()
+    self.world._time = rec[1]
+    self.count += 1
+    self._next(o, m, ev)
@@ -0,0 +1,188 @@
+"""
+A hierarchical timing wheel for the simulator's timers
+
+Students should not need to look at this.
+
+The World keeps two places for pending events: a heap (mostly packet
+deliveries and other one-off work) and one of these (timers).  Each has
+entries that look the same -- (time, key, Event) tuples, where the key
+orders events at the same time (see World._key()).  Since the keys are all
+made the same way, comparing the heads of the two tells the World which one
+to run next, and the overall order is exactly the same as if everything
+were in one big heap.
+
+The wheel has several levels, each with SLOTS slots.  A slot on level 0
+covers a single tick, a slot on level 1 covers SLOTS ticks, and so on.
+Adding an entry just drops it into the right slot, which is O(1).  As the
+cursor moves forward, slots on higher levels get "cascaded" down into the
+lower levels, and when the cursor reaches a level 0 slot, its entries move
+into a small "ready" heap (which usually only holds entries for a single
+tick).  Each entry is cascaded at most once per level, so expiry is O(1)
+too (amortized).
+
+Ticks only determine which slot an entry lands in; entries still fire in
+exact time order.  Entries whose tick the cursor has already passed go
+straight into the ready heap.  Entries too far in the future for the wheel
+(including ones at time infinity) wait in a separate "far" heap until the
+cursor gets close enough to them.
+
+Cancelled entries are left where they are (the World skips them when they
+come up), except that they get dropped instead of cascaded.
+"""
+
+from heapq import heappush, heappop, heapify
+
+
+class TimerWheel (object):
+  TICK = 0.01   # Seconds per tick
+  BITS = 6      # SLOTS = 2**BITS
+  LEVELS = 4    # With the above, the wheel spans about 46 hours
+
+  def __init__ (self, tick = None):
+    if tick is not None: self.TICK = tick
+    self._slots = 1 << self.BITS
+    self._mask = self._slots - 1
+    self._span = 1 << (self.BITS * self.LEVELS)
+    self._levels = [[[] for _ in range(self._slots)]
+                    for _ in range(self.LEVELS)]
+    self._counts = [0] * self.LEVELS # Entries per level
+    self._size = 0 # Entries in all levels (not counting _ready)
+    self._ready = []
+    self._far = []
+    self._cursor = None # Current tick
+
+  def __len__ (self):
+    return self._size + len(self._ready) + len(self._far)
+
+  def add (self, o):
+    """
+    Adds an entry
+
+    o is a (time, key, Event) tuple.
+    """
+    ft = o[0] / self.TICK
+    if self._cursor is None:
+      try:
+        self._cursor = int(ft)
+      except (OverflowError, ValueError):
+        heappush(self._far, o)
+        return
+    cursor = self._cursor
+    bits = self.BITS
+
+    if ft - cursor >= self._span:
+      # Too far in the future (or forever)
+      heappush(self._far, o)
+      return
+
+    tick = int(ft)
+    delta = tick - cursor
+    if delta <= 0:
+      heappush(self._ready, o)
+      return
+    level = 0
+    while delta >> (bits * (level + 1)):
+      level += 1
+    slot = (tick >> (bits * level)) & self._mask
+
+    self._levels[level][slot].append(o)
+    self._counts[level] += 1
+    self._size += 1
+
+  def peek (self):
+    """
+    Returns the earliest entry (or None)
+    """
+    if not self._ready:
+      self._advance()
+      if not self._ready:
+        # Nothing in the wheel at all, but maybe something at infinity
+        return self._far[0] if self._far else None
+    return self._ready[0]
+
+  def pop (self):
+    """
+    Removes and returns the earliest entry
+
+    Only call this after peek() has returned something.
+    """
+    if self._ready: return heappop(self._ready)
+    return heappop(self._far)
+
+  def _take (self, level, slot):
+    """
+    Empties a slot and returns what was in it
+    """
+    slots = self._levels[level]
+    entries = slots[slot]
+    if entries:
+      slots[slot] = []
+      self._counts[level] -= len(entries)
+      self._size -= len(entries)
+    return entries
+
+  def _advance (self):
+    """
+    Moves the cursor forward until there's something in the ready heap
+    """
+    bits = self.BITS
+    mask = self._mask
+    counts = self._counts
+    level0 = self._levels[0]
+    far = self._far
+    while not self._ready:
+      if not self._size:
+        if not far: break
+        # Only far entries left; jump to the first one
+        try:
+          self._cursor = int(far[0][0] / self.TICK) - 1
+        except (OverflowError, ValueError):
+          break # Infinity (or worse); peek() deals with this
+        self._pull_far()
+        continue
+
+      cursor = self._cursor
+
+      if counts[0]:
+        # Look for an occupied slot in the rest of this level 0 rotation.
+        # Getting to one doesn't cross any level boundaries, so we can
+        # jump straight there.
+        found = False
+        for i in range((cursor & mask) + 1, self._slots):
+          if level0[i]:
+            self._cursor = (cursor & ~mask) | i
+            self._ready = self._take(0, i)
+            heapify(self._ready)
+            found = True
+            break
+        if found:
+          if far: self._pull_far()
+          break
+        boundary = 1
+      else:
+        # Skip right over levels with nothing in them
+        boundary = 1
+        while not counts[boundary]:
+          boundary += 1
+
+      # Jump to the next boundary of that level and cascade everything
+      # which starts there, top down.
+      shift = bits * boundary
+      cursor = ((cursor >> shift) + 1) << shift
+      self._cursor = cursor
+      for level in range(self.LEVELS - 1, 0, -1):
+        if cursor & ((1 << (bits * level)) - 1): continue
+        for o in self._take(level, (cursor >> (bits * level)) & mask):
+          if o[2].method is not None: self.add(o)
+      for o in self._take(0, cursor & mask):
+        heappush(self._ready, o)
+      if far: self._pull_far()
+
+  def _pull_far (self):
+    """
+    Moves far entries which are now in range into the wheel
+    """
+    far = self._far
+    limit = (self._cursor + self._span) * self.TICK
+    while far and far[0][0] < limit:
+      self.add(heappop(far))
@@ -0,0 +1,852 @@
+#!/usr/bin/env python
+
+"""
+Tests for the simulator itself
+
+These are separate from dv/unit_tests.py, which tests the DV router.  Run
+with "python sim/unit_tests.py".  Some of them run the simulator in
+subprocesses with a small module (TRACER, below) which records every packet
+delivery, so they take a few seconds.
+"""
+
+from __future__ import print_function
+import sys
+import os
+import random
+import shutil
+import tempfile
+import subprocess
+import threading
+import unittest
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sim_path = os.path.join(dir_path, "..")
+sys.path.insert(0, sim_path)
+
+import sim
+sim.config.console_log = False # For tests which use a World in this process
+
+
+# A simulator module which records every packet delivered to each Entity
+# (in order, and when in the World's own units), plus the routing tables at
+# the end, and writes them to a file.
+# With workers, it runs the simulation with sim.parallel.
+TRACER = '''
+import sys
+import sim.api as api
+import sim.core as core
+
+def collect (entities):
+  r = {}
+  for e in entities:
+    r[e.name] = (getattr(e, "_trace", []),
+                 sorted((d.name, v.port, v.latency, v.expire_time)
+                        for d,v in getattr(e, "table", {}).items()))
+  return r
+
+def dump (results, out):
+  merged = {}
+  for r in results: merged.update(r)
+  with open(out, "w") as f:
+    f.write(repr(sorted(merged.items())))
+
+def launch (out, workers = 0, until = 40.05):
+  workers = int(workers)
+  until = float(until) # Best if it's not exactly when anything happens
+  world = core.world
+  deliver = world.deliver
+  def traced (entity, packet, port):
+    entity.__dict__.setdefault("_trace", []).append(
+        (world._time, port, type(packet).__name__,
+         api.get_name(packet.src), api.get_name(packet.dst)))
+    deliver(entity, packet, port)
+  world.deliver = traced
+
+  hosts = sorted([te.entity for te in core.registry.all_nodes()
+                  if isinstance(te.entity, api.HostEntity)],
+                 key=lambda e: e.name)
+  for i in range(30):
+    a, b = hosts[i % len(hosts)], hosts[(i * 3 + 1) % len(hosts)]
+    if a is not b: world.doLater(10 + i * 0.5, a.ping, b)
+
+  if workers:
+    import sim.parallel
+    sim.parallel.launch(workers, until, collect=collect)
+    run = world.run
+    def go ():
+      run()
+      dump(sim.parallel.results, out)
+    world.run = go
+  else:
+    def stop ():
+      yield until
+      dump([collect([te.entity for te in core.registry.all_nodes()])], out)
+      sys.exit(0)
+    api.run_tasklet(stop)
+'''
+
+
+# A simulator module which has a switch send packets, change them, and send
+# them again, and writes the data of the copies each port got to a file.
+SENDER = '''
+import sys
+import sim.api as api
+import sim.basics as basics
+from sim.cable import Cable
+
+class CaptureCable (Cable):
+  def __init__ (self):
+    self.packets = []
+
+  def transfer (self, packet):
+    self.packets.append(packet)
+
+class UnslottedPacket (api.Packet):
+  def __init__ (self, data):
+    super(UnslottedPacket, self).__init__()
+    self.data = data
+
+def launch (out):
+  s = api.Entity.create("s")
+  cables = []
+  for i in range(3):
+    c = CaptureCable()
+    cables.append(c)
+    s.linkTo(basics.BasicHost.create("h%s" % (i,)), (c, Cable))
+
+  def send_twice (p, flood):
+    s.send(p, None if flood else 0, flood=flood)
+    p.data = "second"
+    s.send(p, None if flood else 0, flood=flood)
+    r = [[c.data for c in cable.packets] for cable in cables]
+    for cable in cables: del cable.packets[:]
+    return r
+
+  r = dict(ping = send_twice(basics.Ping(None, data="first"), True),
+           one_port = send_twice(basics.Ping(None, data="first"), False),
+           unslotted = send_twice(UnslottedPacket("first"), True))
+  # Receivers can flood what they got and then change it too
+  s.send(UnslottedPacket(["first"]), 0)
+  p = cables[0].packets.pop()
+  r['forwarded'] = send_twice(p, True)
+  p = UnslottedPacket(["first"])
+  s.send(p, None, flood=True)
+  p.data.append("second")
+  r['changed'] = [[c.data for c in cable.packets] for cable in cables]
+  with open(out, "w") as f:
+    f.write(repr(sorted(r.items())))
+  sys.exit(0)
+'''
+
+
+# A simulator module in which two Entities schedule events for the same time
+# (the one with the higher ID first), and which writes the order they ran in
+# to a file.
+KEYS = '''
+import sys
+import sim.api as api
+import sim.core as core
+
+ran = []
+
+class Scheduler (api.Entity):
+  def schedule (self, t):
+    core.world.doAt(t, ran.append, self.name)
+
+def launch (out):
+  a = Scheduler.create("a")
+  b = Scheduler.create("b")
+  def go ():
+    now = api.current_time()
+    core.world.doLater(0.1, b.schedule, now + 0.5)
+    core.world.doLater(0.2, a.schedule, now + 0.5)
+    yield 1
+    with open(out, "w") as f:
+      f.write(repr(ran))
+    sys.exit(0)
+  api.run_tasklet(go)
+'''
+
+# A simulator module which branches the simulation while a ping is in flight
+# (from a tasklet) and then from another thread (like the console does), and
+# writes what the branches saw to a file.
+BRANCHER = '''
+import os
+import sys
+import threading
+import sim.api as api
+import sim.core as core
+import sim.basics as basics
+
+class CountingHost (basics.BasicHost):
+  pongs = 0
+
+  def handle_rx (self, packet, port):
+    if isinstance(packet, basics.Pong): self.pongs += 1
+    super(CountingHost, self).handle_rx(packet, port)
+
+def launch (out):
+  # If branch() never returns, give up instead of hanging the test
+  watchdog = threading.Timer(30, os._exit, (1,))
+  watchdog.daemon = True
+  watchdog.start()
+
+  world = core.world
+  h1 = CountingHost.create("h1")
+  h2 = CountingHost.create("h2")
+  h1.linkTo(h2, latency=2)
+  r = {}
+
+  def scenario (i):
+    return (i, world._in_flight(), h1.pongs)
+
+  def console ():
+    r['console'] = world.branch(2, scenario, run_for=1)
+    r['console_after'] = h1.pongs
+    with open(out, "w") as f:
+      f.write(repr(sorted(r.items())))
+    world.do(sys.exit, 0)
+
+  def go ():
+    yield 0.1
+    h1.ping(h2)
+    yield 1
+    r['tasklet'] = world.branch(1, scenario, collect=lambda i: h1.pongs)
+    r['tasklet_in_flight'] = world._in_flight()
+    r['tasklet_after'] = h1.pongs
+    t = threading.Thread(target=console)
+    t.daemon = True
+    t.start()
+  api.run_tasklet(go)
+'''
+
+# A simulator module which links and unlinks Entities a lot and writes which
+# ports things ended up on to a file.
+PORTS = '''
+import sys
+import sim.api as api
+import sim.core as core
+from sim.cable import Cable
+
+def launch (out):
+  e = dict((name, api.Entity.create(name)) for name in "abcdefgh")
+  a = e["a"]
+  r = {}
+
+  def go ():
+    for i in range(1000):
+      a.linkTo(e["b"])
+      yield 0.01
+      a.unlinkTo(e["b"])
+      yield 0.01
+    r["flap_free"] = (list(a._topo._free), list(e["b"]._topo._free))
+    r["flap_ports"] = (len(a._topo.ports), len(e["b"]._topo.ports))
+
+    ports = [a.linkTo(e[n]) for n in "bcd"]
+    a.unlinkTo(e["c"])
+    yield 0.01
+    ports += [a.linkTo(e[n]) for n in "ef"]
+    # Only one direction, so g's end doesn't get a cable and gets reused
+    ports.append(a.linkTo(e["g"], (Cable, None)))
+    ports.append(e["g"].linkTo(e["h"]))
+    r["ports"] = ports
+    r["free"] = list(a._topo._free)
+
+    with open(out, "w") as f:
+      f.write(repr(sorted(r.items())))
+    sys.exit(0)
+  api.run_tasklet(go)
+'''
+
+MODULES = dict(tracer=TRACER, sender=SENDER, keys=KEYS, brancher=BRANCHER,
+               ports=PORTS)
+
+
+class SimulatorTestCase (unittest.TestCase):
+  """
+  Base class for tests which run the simulator
+  """
+  def setUp (self):
+    self.tmp = tempfile.mkdtemp()
+    for name,code in MODULES.items():
+      with open(os.path.join(self.tmp, name + ".py"), "w") as f:
+        f.write(code)
+
+  def tearDown (self):
+    shutil.rmtree(self.tmp)
+
+  def simulate (self, options, virtual = True):
+    """
+    Runs the simulator and returns its output
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([self.tmp, sim_path])
+    cmd = [sys.executable, os.path.join(sim_path, "simulator.py"),
+           "--no-interactive", "--remote-interface=none"]
+    if virtual: cmd.append("--virtual-time")
+    cmd += list(options)
+    p = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT)
+    return p.communicate()[0].decode("utf8", "replace")
+
+  def run_sim (self, name, options, tracer_options = (), virtual = True,
+               module = "tracer"):
+    """
+    Runs the simulator with the tracer (or module) and returns what it wrote
+    """
+    out = os.path.join(self.tmp, name + ".txt")
+    output = self.simulate(["--no-console-log"] + list(options)
+                           + [module, "--out=" + out]
+                           + list(tracer_options), virtual=virtual)
+    self.assertTrue(os.path.exists(out),
+                    "Simulator didn't write %s:\n%s" % (out, output))
+    with open(out) as f:
+      return f.read()
+
+
+class TestPacket (SimulatorTestCase):
+  """
+  Packets and copying them when they're sent
+  """
+  def test_copies_sent (self):
+    r = dict(eval(self.run_sim("sender", [], module="sender")))
+    for name in ("ping", "unslotted", "forwarded"):
+      first = ["first"] if name == "forwarded" else "first"
+      self.assertEqual(r[name], [[first, "second"]] * 3, name)
+    self.assertEqual(r["one_port"], [["first", "second"], [], []])
+    self.assertEqual(r["changed"], [[["first"]]] * 3)
+
+  def test_color_before_init (self):
+    import sim.api as api
+    class ColorPacket (api.Packet):
+      __slots__ = ()
+      def __init__ (self):
+        self.outer_color = [1,0,0,1]
+        super(ColorPacket, self).__init__()
+    self.assertEqual(ColorPacket().outer_color, [1,0,0,1])
+
+  def test_class_color (self):
+    from sim.basics import HostDiscoveryPacket
+    p = HostDiscoveryPacket()
+    self.assertEqual(p.outer_color, HostDiscoveryPacket._outer_color)
+    p.outer_color = [0,1,0,1]
+    self.assertEqual(p.outer_color, [0,1,0,1])
+    self.assertEqual(HostDiscoveryPacket().outer_color,
+                     HostDiscoveryPacket._outer_color)
+
+
+class TestKeys (SimulatorTestCase):
+  """
+  Events at the same time should run in the order they were scheduled
+  """
+  def test_virtual_time (self):
+    self.assertEqual(self.run_sim("keys", [], module="keys"), "['b', 'a']")
+
+  def test_real_time (self):
+    self.assertEqual(self.run_sim("keys", [], module="keys", virtual=False),
+                     "['b', 'a']")
+
+
+@unittest.skipIf(not hasattr(os, "fork"), "Branching requires fork()")
+class TestBranch (SimulatorTestCase):
+  """
+  World.branch() from within the simulation and from another thread
+  """
+  def _run (self, virtual):
+    r = dict(eval(self.run_sim("branch", [], module="brancher",
+                               virtual=virtual)))
+    # From the tasklet, it branches right away, with the ping in flight.
+    # The branch runs until the pong gets back, but that doesn't affect
+    # the original.
+    self.assertEqual(r["tasklet"], [1])
+    self.assertEqual(r["tasklet_after"], 0)
+    self.assertTrue(r["tasklet_in_flight"])
+    # From the console, it waits until nothing is in flight
+    self.assertEqual(r["console"], [(0, 0, 1), (1, 0, 1)])
+    self.assertEqual(r["console_after"], 1)
+
+  def test_virtual_time (self):
+    self._run(True)
+
+  def test_real_time (self):
+    self._run(False)
+
+
+class TestPorts (SimulatorTestCase):
+  """
+  Linking takes the lowest free port, and flapping links doesn't leak
+  """
+  def test_ports (self):
+    r = dict(eval(self.run_sim("ports", [], module="ports")))
+    self.assertEqual(r["flap_free"], ([0], [0]))
+    self.assertEqual(r["flap_ports"], (1, 1))
+    self.assertEqual(r["ports"],
+                     [(0, 0), (1, 0), (2, 0), (1, 0), (3, 0), (4, 0), (0, 0)])
+    self.assertEqual(r["free"], [])
+
+
+class WorldTestCase (unittest.TestCase):
+  """
+  Base class for tests which use a World in this process
+
+  The World runs in virtual time without a remote interface, and it only
+  runs when the test calls run_until().
+  """
+  def setUp (self):
+    self._config = (sim.config.virtual_time, sim.config.remote_interface)
+    sim.config.virtual_time = True
+    sim.config.remote_interface = "none"
+    import sim.core as core
+    self.world = core.World()
+    core.registry = core.EntityRegistry()
+    self.ran = []
+
+  def tearDown (self):
+    sim.config.virtual_time, sim.config.remote_interface = self._config
+
+  def start (self):
+    """
+    Starts the World (without running anything), as if from the simulation
+    """
+    self.assertEqual(self.world.run_until(), "idle")
+
+
+class TestEvents (WorldTestCase):
+  """
+  Cancelling events and keeping track of the cancelled ones
+  """
+  def test_cancel (self):
+    w = self.world
+    self.start()
+    w.doLater(1, self.ran.append, 1)
+    ev = w.doLater(2, self.ran.append, 2)
+    w.doLater(3, self.ran.append, 3)
+    ev.cancel()
+    self.assertFalse(ev.pending)
+    self.assertEqual(w._dead, 1)
+    self.assertEqual(w._in_flight(), 2)
+    self.assertEqual(w.run_until(), "idle")
+    self.assertEqual(self.ran, [1, 3])
+    self.assertEqual((w._dead, w.queue), (0, []))
+
+  def test_cancel_before_start (self):
+    w = self.world
+    w.doLater(5, self.ran.append, 5).cancel()
+    w.doLater(1, self.ran.append, 1)
+    self.assertEqual(w.run_until(max_time=10), "idle")
+    self.assertEqual(self.ran, [1])
+    self.assertEqual(w._dead, 0)
+
+  def test_cancel_timer (self):
+    w = self.world
+    self.start()
+    w.doTimerLater(1, self.ran.append, 1).cancel()
+    self.assertEqual(w._dead, 0) # Timers aren't in the heap
+    self.assertEqual(w._in_flight(), 0)
+
+  def test_cancel_other_thread (self):
+    w = self.world
+    self.start()
+    def other ():
+      w.doLater(1, self.ran.append, 1).cancel()
+      w.doLater(2, self.ran.append, 2)
+    t = threading.Thread(target=other)
+    t.start()
+    t.join()
+    self.assertEqual(len(w._inbox), 2)
+    self.assertEqual(w._in_flight(), 1)
+    self.assertEqual(w.run_until(), "idle")
+    self.assertEqual(self.ran, [2])
+    self.assertEqual(w._dead, 0)
+
+  def test_compaction (self):
+    w = self.world
+    self.start()
+    evs = [w.doLater(i, self.ran.append, i) for i in range(3000)]
+    for ev in evs[:2000]:
+      ev.cancel()
+      # Never more than half dead (once there are enough to bother)
+      self.assertTrue(w._dead < w.COMPACT_MIN or w._dead * 2 < len(w.queue))
+    self.assertLess(len(w.queue), 3000)
+    self.assertEqual(w._in_flight(), 1000)
+    self.assertEqual(w.run_until(), "idle")
+    self.assertEqual(self.ran, list(range(2000, 3000)))
+    self.assertEqual((w._dead, w.queue), (0, []))
+
+
+class TestBatches (WorldTestCase):
+  """
+  Packets which arrive at the same time and handle_rx_batch()
+  """
+  def _send_together (self, dst, make_packet):
+    """
+    Has three Entities linked to dst each send it a packet at once
+
+    Returns the cables the packets come in on.
+    """
+    import sim.api as api
+    senders = [api.Entity.create("n%s" % (i,)) for i in range(3)]
+    for s in senders:
+      s.linkTo(dst, latency=1)
+    self.start()
+    self.world.run_until(max_time=5) # Let the links come up
+    del self.ran[:]
+    for s in senders:
+      s.send(make_packet(), 0)
+    return [s._topo.ports[0] for s in senders]
+
+  def test_handle_rx (self):
+    import sim.api as api
+    w = self.world
+    ran = self.ran
+    class Receiver (api.Entity):
+      def handle_rx (self, packet, port):
+        ran.append(w._current.__self__)
+    r = Receiver.create("r")
+    cables = self._send_together(r, api.Packet)
+    self.assertEqual(w.run_until(), "idle")
+    # One at a time, as each cable delivers it
+    self.assertEqual(ran, cables)
+    self.assertEqual(w._rx_batches, {})
+
+  def test_dv_batch (self):
+    import sim.api as api
+    from dv.router import DVRouter
+    from dv.dv_base import AdvertisementPacket
+    w = self.world
+    ran = self.ran
+    class Router (DVRouter):
+      def start_timer (self, interval = None):
+        pass # No periodic updates
+
+      def handle_rx_batch (self, packets):
+        ran.append(("batch", len(packets), w._current == w._flush_rx))
+        DVRouter.handle_rx_batch(self, packets)
+
+      def expire_routes (self):
+        ran.append("expire")
+        DVRouter.expire_routes(self)
+
+      def send_routes (self, force = False, single_port = None):
+        ran.append(("send_routes", force, single_port, self._in_batch))
+        DVRouter.send_routes(self, force, single_port)
+    r = Router.create("r")
+    h = api.HostEntity.create("h")
+    self._send_together(r, lambda: AdvertisementPacket(h, 1))
+    self.assertEqual(w.run_until(), "idle")
+    self.assertEqual(ran, [("batch", 3, True), "expire"]
+                          + [("send_routes", False, None, True)] * 3
+                          + [("send_routes", False, None, False), "expire"])
+    self.assertEqual(r.table[h].latency, 2)
+
+
+class TestCables (WorldTestCase):
+  """
+  Packets on BasicCables
+  """
+  def _link (self, cable):
+    """
+    Links a sender to a receiver with cable, and returns the sender
+
+    The receiver puts (time, ping data) in self.ran for what it gets.
+    """
+    import sim.api as api
+    w = self.world
+    ran = self.ran
+    class Receiver (api.Entity):
+      def handle_rx (self, packet, port):
+        ran.append((round(w.time, 6), packet.data))
+    a = api.Entity.create("a")
+    a.linkTo(Receiver.create("b"), (cable, None))
+    self.start()
+    return a
+
+  def _send (self, a, data):
+    import sim.basics as basics
+    for d in data:
+      a.send(basics.Ping(None, data=d), 0)
+
+  def test_fifo (self):
+    from sim.cable import BasicCable
+    cable = BasicCable(latency=1)
+    a = self._link(cable)
+    self._send(a, range(4))
+    self.assertFalse(cable._reorder)
+    # (time, key, packet)
+    self.assertEqual([(round(t, 6), p.data) for t,key,p in cable.queue],
+                     [(1.1, 0), (1.2, 1), (1.3, 2), (1.4, 3)])
+    self.assertEqual(self.world.run_until(), "idle")
+    # One after another, each taking tx_time to send
+    self.assertEqual(self.ran, [(1.1, 0), (1.2, 1), (1.3, 2), (1.4, 3)])
+
+  def test_to_heap (self):
+    from sim.cable import BasicCable
+    cable = BasicCable(latency=10)
+    a = self._link(cable)
+    self._send(a, [0, 1])
+    cable.latency = 1
+    self._send(a, [2, 3])
+    # The new ones come out first, so it switched to a heap
+    self.assertTrue(cable._reorder)
+    self.assertEqual(self.world.run_until(), "idle")
+    self.assertEqual(self.ran, [(1.3, 2), (1.4, 3), (10.1, 0), (10.2, 1)])
+
+  def _deliveries (self, cable):
+    """ Number of deliver() events pending for cable """
+    return sum(1 for o in self.world.queue if o[2].method == cable.deliver)
+
+  def test_one_delivery (self):
+    from sim.cable import BasicCable
+    cable = BasicCable(latency=1)
+    a = self._link(cable)
+    self._send(a, range(4))
+    self.assertEqual(self._deliveries(cable), 1)
+    self.world.run_until(max_time=1.25)
+    self.assertEqual(self.ran, [(1.1, 0), (1.2, 1)])
+    self.assertEqual(self._deliveries(cable), 1)
+    self.assertEqual(self.world.run_until(), "idle")
+    self.assertEqual(len(self.ran), 4)
+    self.assertEqual(self._deliveries(cable), 0)
+
+  def test_disconnect (self):
+    from sim.cable import BasicCable
+    cable = BasicCable(latency=1)
+    a = self._link(cable)
+    self._send(a, range(4))
+    wakeup = cable._wakeup
+    a.unlinkTo(cable.dstEnt)
+    # The packets on the wire are lost, and the delivery is cancelled right
+    # away (before they would have come out)
+    self.assertEqual(self.world.run_until(max_time=0.5), "idle")
+    self.assertFalse(wakeup.pending)
+    self.assertEqual(cable.next_delivery, None)
+    self.assertEqual(len(cable.queue), 0)
+    self.assertEqual(self._deliveries(cable), 0)
+    self.assertEqual(self.world.run_until(), "idle")
+    self.assertEqual(self.ran, [])
+
+  def test_queue_size (self):
+    from sim.cable import BasicCable
+    cable = BasicCable(latency=1, queue_size=2)
+    a = self._link(cable)
+    self._send(a, range(4))
+    self.assertEqual(len(cable.queue), 2)
+    self.assertEqual(self.world.run_until(), "idle")
+    self.assertEqual(self.ran, [(1.1, 0), (1.2, 1)])
+
+  def test_queue_size_heap (self):
+    from sim.cable import BasicCable
+    class ReorderCable (BasicCable):
+      REORDER = True
+    cable = ReorderCable(latency=10, queue_size=3)
+    a = self._link(cable)
+    self._send(a, [0, 1])
+    cable.latency = 1
+    self._send(a, [2, 3])
+    self.assertEqual(len(cable.queue), 3)
+    self.assertEqual(self.world.run_until(), "idle")
+    self.assertEqual(self.ran, [(1.3, 2), (10.1, 0), (10.2, 1)])
+
+
+
+class TestBulk (WorldTestCase):
+  """
+  Building a topology inside bulk()
+  """
+  def _build (self, use_bulk):
+    """
+    Builds a ring of switches (plus a chord) and runs it
+
+    Returns what was sent to the interface and the handle_link_up() calls.
+    """
+    import sim.api as api
+    import sim.comm as comm
+    import sim.core as core
+    self.world = core.World()
+    core.registry = core.EntityRegistry()
+    sent = []
+    class Interface (comm.NullInterface):
+      def send_snapshot (self):
+        sent.append("snapshot")
+      def send_entity_up (self, name, kind):
+        sent.append(("entity_up", name))
+      def send_link_up (self, srcid, sport, dstid, dport):
+        sent.append(("link_up", srcid, sport, dstid, dport))
+    core.events = Interface()
+    link_ups = []
+    class Switch (api.Entity):
+      def handle_link_up (self, port, latency):
+        link_ups.append((self.name, port, latency))
+    def build ():
+      s = [Switch.create("s%s" % i) for i in range(4)]
+      for i in range(4):
+        s[i].linkTo(s[(i + 1) % 4], latency = i + 1)
+      s[0].linkTo(s[2], latency = 5)
+    if use_bulk:
+      with api.bulk():
+        build()
+    else:
+      build()
+    self.start()
+    return sent, link_ups
+
+  def test_one_snapshot (self):
+    sent, link_ups = self._build(True)
+    self.assertEqual(sent, ["snapshot"])
+    self.assertEqual(len(link_ups), 10)
+
+  def test_link_up_order (self):
+    sent, link_ups = self._build(False)
+    self.assertNotIn("snapshot", sent)
+    self.assertEqual(len([x for x in sent if x[0] == "entity_up"]), 4)
+    self.assertEqual(len([x for x in sent if x[0] == "link_up"]), 5)
+    self.assertEqual(self._build(True)[1], link_ups)
+
+
+class TestTimerWheel (unittest.TestCase):
+  """
+  The timer wheel should give entries back in the same order as a heap
+  """
+  def _compare (self, seed, tick, scale, integer = False):
+    from heapq import heappush, heappop
+    import sim.core as core
+    from sim.timerwheel import TimerWheel
+    rng = random.Random(seed)
+    wheel = TimerWheel(tick)
+    heap = []
+    events = []
+    now = 0
+    key = 0
+
+    def pop ():
+      # Like the World, skip cancelled entries
+      while True:
+        o = wheel.peek()
+        if o is None: break
+        wheel.pop()
+        if o[2].pending: break
+      while heap and not heap[0][2].pending:
+        heappop(heap)
+      expected = heappop(heap) if heap else None
+      self.assertIs(o, expected, "seed %s" % (seed,))
+      return o
+
+    for i in range(5000):
+      r = rng.random()
+      if r < 0.5:
+        r = rng.random()
+        if r < 0.02:
+          t = float("inf")
+        elif r < 0.1:
+          t = now
+        elif r < 0.15:
+          t = now + rng.random() * scale * 1e9 # Past the end of the wheel
+        else:
+          t = now + rng.expovariate(1) * scale * rng.choice((0.01, 1, 100))
+          if integer: t = int(t)
+        ev = core.Event(pop, timer=True)
+        o = (t, key, ev)
+        key += 1
+        wheel.add(o)
+        heappush(heap, o)
+        events.append(ev)
+      elif r < 0.6:
+        if events: rng.choice(events).cancel()
+      else:
+        o = pop()
+        if o is not None and o[0] != float("inf"): now = o[0]
+    while pop() is not None:
+      pass
+
+  def test_seconds (self):
+    for seed in range(5):
+      self._compare(seed, 0.01, 1)
+
+  def test_ticks (self):
+    # With --tick, times are integers and the wheel's tick is big
+    for seed in range(5):
+      self._compare(seed, 1e7, 1e9, integer=True)
+
+
+@unittest.skipIf(sys.version_info < (3,),
+                 "Python 2 dicts keyed on Entities aren't in a repeatable order")
+class TestParallel (SimulatorTestCase):
+  """
+  sim.parallel should do everything in the same order as a single process
+  """
+  TOPO = ["--default-switch-type=dv.router", "topos.rand", "--switches=30",
+          "--hosts=8", "--links=50"]
+
+  def _compare (self, options):
+    single = self.run_sim("single", options)
+    self.assertIn("Ping", single)
+    for workers in (2, 3):
+      parallel = self.run_sim("parallel%s" % (workers,), options,
+                              ["--workers=%s" % (workers,)])
+      self.assertEqual(single, parallel,
+                       "%s workers did things differently" % (workers,))
+
+  def test_same_trace (self):
+    self._compare(self.TOPO + ["--seed=3"])
+
+  def test_same_trace_ticks (self):
+    self._compare(["--tick"] + self.TOPO + ["--seed=11"])
+
+
+class TestWaitUntil (SimulatorTestCase):
+  """
+  examples/test_simple waits for its pings with api.wait_until()
+  """
+  def _run (self, options = ()):
+    output = self.simulate(list(options) + ["--default-switch-type=dv.router",
+                                            "examples.test_simple"])
+    self.assertIn("Test passed successfully", output)
+
+  def test_wait_until (self):
+    self._run()
+
+  @unittest.skipIf(sys.version_info < (3,), "asyncio requires Python 3")
+  def test_wait_until_asyncio (self):
+    self._run(["--asyncio"])
+
+
+@unittest.skipIf(sys.version_info < (3,),
+                 "Python 2 dicts keyed on Entities aren't in a repeatable order")
+class TestReplay (SimulatorTestCase):
+  """
+  Replaying a recording should do exactly what the recorded run did
+  """
+  TOPO = ["--default-switch-type=dv.router", "topos.rand", "--switches=10",
+          "--hosts=4", "--links=15", "--seed=7"]
+
+  def _round_trip (self, options, virtual = True, until = "40.05"):
+    rec = os.path.join(self.tmp, "run.rec")
+    recorded = self.run_sim("recorded", ["--record=" + rec] + options,
+                            ["--until=" + until], virtual=virtual)
+    self.assertIn("Ping", recorded)
+    replayed = self.run_sim("replayed", ["--replay=" + rec] + options,
+                            ["--until=" + until])
+    self.assertEqual(recorded, replayed)
+
+  def test_virtual_time (self):
+    self._round_trip(self.TOPO)
+
+  def test_real_time_ticks (self):
+    # This runs 20 seconds at 10x (pings start at 10 seconds)
+    self._round_trip(["--tick=1e-9", "--speed=10"] + self.TOPO,
+                     virtual=False, until="20")
+
+  def test_real_time_tiny_ticks (self):
+    # Real time is since the epoch, so it's too many of these ticks for a
+    # 64 bit integer
+    self._round_trip(["--tick=1e-10", "--speed=10"] + self.TOPO,
+                     virtual=False, until="20")
+
+  def test_big_ticks (self):
+    # Times get past 2**53 ticks after a few seconds, so they can't be
+    # recorded as doubles
+    self._round_trip(["--tick=3e-16"] + self.TOPO)
+
+
+if __name__ == '__main__':
+  unittest.main()
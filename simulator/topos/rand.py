@@ -1,4 +1,5 @@
 import sim
+import sim.api as api
 import random
 
 
@@ -66,17 +67,18 @@ def launch (switch_type = sim.config.default_switch_type, host_type = sim.config
       l -= 1
       links.add((an,bn))
 
-    switches = []
-    for i in range(n):
-      switches.append( switch_type.create('s' + str(i+1)) )
-    for u,v in sorted(links):
-      switches[u].linkTo(switches[v], latency=latency)
+    with api.bulk():
+      switches = []
+      for i in range(n):
+        switches.append( switch_type.create('s' + str(i+1)) )
+      for u,v in sorted(links):
+        switches[u].linkTo(switches[v], latency=latency)
 
-    for i in range(h):
-      host = host_type.create('h' + str(i+1))
+      for i in range(h):
+        host = host_type.create('h' + str(i+1))
 
-      switch = rand.choice(switches)
-      if not multiple_hosts:
-        switches.remove(switch)
+        switch = rand.choice(switches)
+        if not multiple_hosts:
+          switches.remove(switch)
 
-      switch.linkTo(host, latency=latency)
+        switch.linkTo(host, latency=latency)